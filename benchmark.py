@@ -0,0 +1,299 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from psycopg2 import sql as psycopg2_sql
+
+import postgres_handler
+import lab_file_handler
+import lab_to_db_updater
+import csv_creater
+import measurement_registry
+
+"""
+This program times the ways lab records can be added to the database so that changes to the ingestion code can be compared.
+
+Everything is done inside a single transaction that is rolled back at the end, so the database is left as it was found. The lab tables are emptied inside that transaction before each run so that every run adds the same records.
+
+The lab files can be repeated with altered material_uid values to simulate larger lab directories (e.g., 100 copies of the 88 x-lab-data files adds 8800 records).
+
+With --materials, csv_creater.split_and_merge_materials is compared with the original loop (split_and_merge_materials_loop) on synthetic processes using 10, 100 and 1000 (or the given numbers of) materials. This does not need a database.
+
+With --synthetic N, a corpus of N ball milling and hot press processes, their materials and matching ICP and Hall lab files is generated instead (see generate_corpus). The process tables are replaced with the synthetic processes inside the transaction and every stage of the pipeline is timed (see benchmark_pipeline), reporting the throughput and peak Python memory use of each stage.
+"""
+
+# Fields of the lab files written by generate_corpus, in the order they appear in the X-LABS files
+# {identifier : [(field name, function(random.Random) returning the value)]}
+synthetic_lab_fields = {'ICP' : [('Pb concentration', lambda rng: round(rng.uniform(0, 2), 1)),
+                                 ('Sn concentration', lambda rng: round(rng.uniform(0, 2), 1)),
+                                 ('O Concentration', lambda rng: round(rng.uniform(0, 2), 1)),
+                                 ('Gas Flow Rate (L/min)', lambda rng: rng.choice([12, 13, 14])),
+                                 ('Gas Type', lambda rng: 'Ar'),
+                                 ('Plasma Temperature (celsius)', lambda rng: rng.choice([8000, 10000])),
+                                 ('Detector Temperature (celsius)', lambda rng: 0),
+                                 ('Field Strength (T)', lambda rng: 1),
+                                 ('Plasma Observation', lambda rng: rng.choice(['Radial', 'Axial'])),
+                                 ('Radio Frequency (MHz)', lambda rng: rng.choice([27, 30]))],
+                        'Hall' : [('Probe Resistance (ohm)', lambda rng: round(rng.uniform(1, 8), 1)),
+                                  ('Gas Flow Rate (L/min)', lambda rng: 1),
+                                  ('Gas Type', lambda rng: 'Ar'),
+                                  ('Probe Material', lambda rng: 'W'),
+                                  ('Current (mA)', lambda rng: 0.1),
+                                  ('Field Strength (T)', lambda rng: 5),
+                                  ('Sample Position', lambda rng: rng.choice([1, 2])),
+                                  ('Magnet Reversal', lambda rng: rng.choice(['True', 'False']))]}
+
+# Materials procured for each synthetic ball milling process
+synthetic_materials = ['Zn', 'Cu', 'Se']
+
+def generate_corpus(lab_files_directory, count, lab_fraction=0.5, seed=0):
+    """
+    Writes synthetic lab files to lab_files_directory and returns the matching process records as a dictionary {table name : list of records as dictionaries}.
+
+    count ball milling processes are made, each joined to its own hot press process and procuring every material in synthetic_materials. Each ICP and Hall measurement of each process output material has a lab file with probability lab_fraction. The same seed always makes the same corpus.
+    """
+    rng = random.Random(seed)
+    os.makedirs(lab_files_directory, exist_ok=True)
+    tables = {csv_creater.sql_ball_milling_table_name : [],
+              csv_creater.sql_hot_press_table_name : [],
+              csv_creater.sql_materials_table_name : []}
+    for n in range(count):
+        ball_milling_uid = f'SYN-BM{n:07d}'
+        hot_press_uid = f'SYN-HP{n:07d}'
+        output_material_uids = [f'SYN-BM-M{n:07d}', f'SYN-HP-M{n:07d}']
+        tables[csv_creater.sql_ball_milling_table_name].append({
+            'uid' : ball_milling_uid, 'process_name' : 'high energy ball milling',
+            'milling_time' : rng.choice([15, 30, 45, 60]), 'milling_time_units' : 'hr',
+            'milling_speed' : rng.choice([200, 225, 250, 275, 300]), 'milling_speed_units' : 'rpm',
+            'output_material_name' : 'powder', 'output_material_uid' : output_material_uids[0], 'hot_press_uid' : hot_press_uid})
+        tables[csv_creater.sql_hot_press_table_name].append({
+            'uid' : hot_press_uid, 'process_name' : 'Hot Isostatic Press',
+            'hot_press_temperature' : rng.choice([850, 900]), 'hot_press_temperature_units' : 'degC',
+            'hot_press_pressure' : rng.choice([100, 200]), 'hot_press_pressure_units' : 'MPa',
+            'hot_press_time' : rng.choice([0.5, 1]), 'hot_press_time_units' : 'hr',
+            'output_material_name' : 'final pellet', 'output_material_uid' : output_material_uids[1]})
+        for m, material in enumerate(synthetic_materials):
+            tables[csv_creater.sql_materials_table_name].append({
+                'uid' : f'SYN-PR-{n:07d}-{m}', 'material_name' : material,
+                'mass_fraction' : round(rng.uniform(0, 1), 2), 'ball_milling_uid' : ball_milling_uid})
+
+        # Write the lab files for the output materials
+        for material_uid in output_material_uids:
+            for identifier, fields in synthetic_lab_fields.items():
+                if rng.random() < lab_fraction:
+                    lines = ['              X-LABS DATA FORM', '============================================',
+                             f'material_uid\t{material_uid}', f'Measurement\t{identifier}']
+                    lines += [f'{name}\t{value(rng)}' for name, value in fields]
+                    with open(os.path.join(lab_files_directory, f'{identifier}-{material_uid}.txt'), 'w') as file:
+                        file.write('\n'.join(lines) + '\n')
+    return tables
+
+def replace_process_tables(sql, tables):
+    """
+    Replaces the rows of the process tables with the records from generate_corpus. Only to be used inside a transaction that is rolled back.
+
+    Rows are deleted from tables referencing other tables first and inserted into referenced tables first, so the foreign keys in processdb.sql (material_procurement to ball_milling to hot_press) hold throughout.
+    """
+    table_names = [csv_creater.sql_hot_press_table_name, csv_creater.sql_ball_milling_table_name, csv_creater.sql_materials_table_name]
+    for table_name in reversed(table_names):
+        sql.cur.execute(psycopg2_sql.SQL("DELETE FROM {};").format(psycopg2_sql.Identifier(table_name)))
+    for table_name in table_names:
+        records = tables[table_name]
+        if records:
+            sql.add_records(table_name, records, {column : column for column in records[0]})
+
+def tables_with_rows(sql, table_names):
+    """
+    Returns the list of the tables in table_names that exist and have rows.
+    """
+    found = []
+    for table_name in table_names:
+        if sql.check_table_exists(table_name):
+            sql.cur.execute(psycopg2_sql.SQL("SELECT EXISTS (SELECT 1 FROM {});").format(psycopg2_sql.Identifier(table_name)))
+            if sql.cur.fetchone()[0]:
+                found.append(table_name)
+    return found
+
+def time_stage(name, function, count, unit):
+    """
+    Runs function, prints its time, throughput (count units per second) and peak Python memory use and returns its result.
+
+    Memory is measured with tracemalloc, which only sees allocations made through Python (including numpy and pandas) and slows the stage down; the timings are meant for comparing runs with each other.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # stages too quick for the timer have no throughput
+    rate = f"{count / seconds:.0f}" if seconds > 0 else "-"
+    print(f"{name}: {count} {unit} in {seconds:.3f}s ({rate} {unit}/s), peak memory {peak / 2 ** 20:.1f} MiB")
+    return result
+
+def scale_lab_files(files, copies):
+    """
+    Returns the list of lab file dictionaries repeated "copies" times, with each copy given unique material_uid values.
+    """
+    if copies == 1:
+        return files
+    scaled_files = []
+    for copy in range(copies):
+        for file in files:
+            scaled_file = dict(file)
+            scaled_file[lab_to_db_updater.unique_id_column_name] = file[lab_to_db_updater.unique_id_column_name] + '-' + str(copy)
+            scaled_files.append(scaled_file)
+    return scaled_files
+
+def empty_lab_tables(sql):
+    """
+    Deletes all rows from the lab tables. Only to be used inside a transaction that is rolled back.
+    """
+    for measurement_type in measurement_registry.measurement_types():
+        sql.create_table(measurement_type['sql_table_name'], measurement_type['sql_column_string'])
+        sql.cur.execute(psycopg2_sql.SQL("DELETE FROM {};").format(psycopg2_sql.Identifier(measurement_type['sql_table_name'])))
+
+def time_ingestion(sql, add_records_function, files):
+    """
+    Runs add_records_function against empty lab tables and then again once all records exist. Returns a tuple of seconds taken and records added for each run.
+    """
+    empty_lab_tables(sql)
+    measurements = lab_to_db_updater.create_measurements()
+
+    start = time.perf_counter()
+    new_count = add_records_function(sql, measurements, files)
+    new_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    existing_count = add_records_function(sql, measurements, files)
+    existing_seconds = time.perf_counter() - start
+
+    return (new_seconds, new_count), (existing_seconds, existing_count)
+
+def benchmark_ingestion(connect_statement, lab_files_directory, copies=1):
+    """
+    Compares add_lab_records_row_at_a_time and add_lab_records on the lab files in lab_files_directory and prints the results.
+    """
+    lab_handler = lab_file_handler.Lab_File_Handler(lab_files_directory)
+    lab_handler.collect_lab_files()
+    files = scale_lab_files(lab_handler.files, copies)
+
+    sql = postgres_handler.SQL_Connector(connect_statement)
+    ingestion_functions = [('row at a time', lab_to_db_updater.add_lab_records_row_at_a_time),
+                           ('bulk', lab_to_db_updater.add_lab_records)]
+    try:
+        print(len(files), 'lab files')
+        for name, add_records_function in ingestion_functions:
+            new_run, existing_run = time_ingestion(sql, add_records_function, files)
+            print(f"{name}: {new_run[1]} records added in {new_run[0]:.3f}s ({len(files) / new_run[0]:.0f} files/s), "
+                  f"rerun with all records existing in {existing_run[0]:.3f}s ({len(files) / existing_run[0]:.0f} files/s)")
+            sql.rollback()
+    finally:
+        sql.rollback()
+        sql.disconnect()
+
+def synthetic_materials_frames(material_count, process_count=1000):
+    """
+    Returns a DataFrame of process_count ball milling processes (as merged with hot press by csv_creater.build_master_dataframe) and a material_procurement DataFrame in which each process procures material_count materials.
+    """
+    ball_milling_uids = [f'SYN-BM{n:07d}' for n in range(process_count)]
+    merge_df = pd.DataFrame({csv_creater.hot_press_uid_column + csv_creater.ball_milling_suffix : ball_milling_uids,
+                             'milling_time' : [15.0] * process_count})
+    materials_df = pd.DataFrame([(f'SYN-PR-{n:07d}-{m}', f'Material{m}', 1 / material_count, ball_milling_uid)
+                                 for n, ball_milling_uid in enumerate(ball_milling_uids) for m in range(material_count)],
+                                columns=['uid', csv_creater.material_type_column, 'mass_fraction', csv_creater.materials_ball_milling_column])
+    return merge_df, materials_df
+
+def benchmark_materials(material_counts=(10, 100, 1000), process_count=1000):
+    """
+    Compares csv_creater.split_and_merge_materials_loop and csv_creater.split_and_merge_materials on synthetic processes procuring each number of materials in material_counts and prints the results.
+    """
+    merge_functions = [('loop', csv_creater.split_and_merge_materials_loop),
+                       ('pivot', csv_creater.split_and_merge_materials)]
+    for material_count in material_counts:
+        merge_df, materials_df = synthetic_materials_frames(material_count, process_count)
+        for name, merge_function in merge_functions:
+            time_stage(f'{name} with {material_count} materials',
+                       lambda: merge_function(merge_df=merge_df,
+                                              materials_df=materials_df,
+                                              merge_df_column_to_merge_on=csv_creater.hot_press_uid_column + csv_creater.ball_milling_suffix,
+                                              materials_df_column_to_merge_on=csv_creater.materials_ball_milling_column,
+                                              material_type_column_name=csv_creater.material_type_column),
+                       len(materials_df), 'material rows')
+
+def benchmark_pipeline(connect_statement, lab_files_directory, count, lab_fraction=0.5, seed=0, replace_existing=False):
+    """
+    Generates a synthetic corpus of count processes in lab_files_directory (see generate_corpus) and times each stage of the pipeline against it: reading the lab files, adding them to the database and creating the master csv with each engine. The master csvs are written to a temporary directory.
+
+    The process tables are replaced with the synthetic processes inside a transaction that is rolled back, so the database is left as it was found. The tables are locked until the benchmark finishes, though, so it should be run against a throwaway database: unless replace_existing is True, nothing is done if the process or lab tables already have rows.
+    """
+    sql = postgres_handler.SQL_Connector(connect_statement)
+    try:
+        if not replace_existing:
+            table_names = [csv_creater.sql_hot_press_table_name, csv_creater.sql_ball_milling_table_name, csv_creater.sql_materials_table_name]
+            table_names += [measurement_type['sql_table_name'] for measurement_type in measurement_registry.measurement_types()]
+            found = tables_with_rows(sql, table_names)
+            if found:
+                print('Not running: these tables already have rows:', ', '.join(found))
+                print('Use a throwaway database with empty tables (e.g., the schema of processdb.sql without its data) or pass --replace-existing.')
+                return
+
+        tables = time_stage('generate corpus', lambda: generate_corpus(lab_files_directory, count, lab_fraction, seed), count, 'processes')
+        file_count = len(lab_file_handler.Lab_File_Handler(lab_files_directory).lab_filenames)
+        row_count = len(tables[csv_creater.sql_ball_milling_table_name])
+
+        lab_to_db_updater.create_lab_tables(sql)
+        empty_lab_tables(sql)
+        replace_process_tables(sql, tables)
+
+        lab_handler = lab_file_handler.Lab_File_Handler(lab_files_directory)
+        time_stage('collect_lab_files', lab_handler.collect_lab_files, file_count, 'files')
+        time_stage('add_new_lab_results', lambda: lab_to_db_updater.add_new_lab_results(sql, lab_files_directory), file_count, 'files')
+        with tempfile.TemporaryDirectory() as output_directory:
+            time_stage('create master csv (pandas)',
+                       lambda: csv_creater.build_master_dataframe(sql).to_csv(os.path.join(output_directory, 'pandas.csv')),
+                       row_count, 'rows')
+            time_stage('create master csv (sql)',
+                       lambda: csv_creater.write_master_csv_sql(sql, os.path.join(output_directory, 'sql.csv')),
+                       row_count, 'rows')
+    finally:
+        sql.rollback()
+        sql.disconnect()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time adding lab records and the other stages of the pipeline. Nothing is saved to the database.")
+    parser.add_argument('lab_files_directory', nargs='?',
+                        help="The directory where only lab.txt files are located (e.g., 'lab_files/'). With --synthetic, the directory the synthetic lab files are written to.")
+    parser.add_argument('connect_statement', nargs='?',
+                        help="A SQL connection argument to your database (e.g., 'dbname=citrine user=dale').")
+    parser.add_argument('copies', type=int, nargs='?', default=1,
+                        help="The number of copies of the lab files to use (default 1).")
+    parser.add_argument('--synthetic', type=int, default=None, metavar='N',
+                        help="Generate a synthetic corpus of N processes and their lab files and time every stage of the pipeline.")
+    parser.add_argument('--lab-fraction', type=float, default=0.5,
+                        help="With --synthetic, the chance each measurement of each output material has a lab file (default 0.5).")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="With --synthetic, the random seed used to generate the corpus (default 0).")
+    parser.add_argument('--replace-existing', action='store_true',
+                        help="With --synthetic, run even if the process or lab tables already have rows. They are replaced inside a transaction that is rolled back, but are locked until the benchmark finishes.")
+    parser.add_argument('--materials', type=int, nargs='*', default=None, metavar='N',
+                        help="Compare ways of adding material columns to the master csv with each number of materials (default 10 100 1000). No database is needed.")
+    parser.add_argument('--processes', type=int, default=1000,
+                        help="With --materials, the number of ball milling processes (default 1000).")
+    args = parser.parse_args()
+
+    if args.materials is not None:
+        benchmark_materials(args.materials or (10, 100, 1000), args.processes)
+    elif not args.lab_files_directory or not args.connect_statement:
+        parser.error("the lab files directory and connection argument are required")
+    elif args.synthetic:
+        benchmark_pipeline(args.connect_statement, args.lab_files_directory, args.synthetic, args.lab_fraction, args.seed,
+                           replace_existing=args.replace_existing)
+    else:
+        benchmark_ingestion(args.connect_statement, args.lab_files_directory, args.copies)
@@ -1,38 +1,293 @@
+import argparse
+import cProfile
+import os
+import pstats
 import sys
+import time
 
+import postgres_handler
 import lab_to_db_updater
 import csv_creater
+import run_metrics
+import ingestion_manifest
+import lab_watcher
+import lab_file_handler
+import measurement_registry
+import table_cache
 
 """
 This program creates a master csv to combine lab results with procurement and material processing data. From the SQL database, it relies on the material_procurement, ball_milling, and hot_press tables. It handles ICP and Hall lab results files, recording measurments for the Ball Milling and Hot Press processes, by uploading this information to the SQL database and then combining it into a master csv.
 
-Any updates or formating changes to the lab result files or additional measurements should be handled in lab_to_db_updater.py file, but will also affect the csv_creater file which only handles ICP and Hall measurements.
+Any updates or formating changes to the lab result files should be handled in lab_to_db_updater.py file. Additional measurements are added by describing them in a json file in the measurements directory (see measurement_registry); both lab_to_db_updater and csv_creater handle every measurement described there.
 
 Changes to the SQL database, particularly column names, will affect the create_master_csv function in csv_creater file.
 """
 
-if __name__ == '__main__':
-    if len(sys.argv) == 3:
-        # collect arguements provided
-        lab_files_directory = sys.argv[1]
-        connect_statement = sys.argv[2]
+def open_table_cache(args):
+    """
+    Returns the table_cache.Table_Cache given by the command line arguments, or None if --no-cache was given or pyarrow is not installed.
+    """
+    if args.no_cache:
+        return None
+    try:
+        return table_cache.Table_Cache(args.table_cache, max_bytes=args.table_cache_size * 1024 * 1024)
+    except ImportError:
+        print('pyarrow is not installed; tables will not be cached')
+        return None
+
+def run(args):
+    """
+    Adds the lab files to the database and creates the master csv using the parsed command line arguments.
+    """
+    # collect arguements provided
+    connect_statement = args.connect_statement
+    try:
+        lab_files_directories = lab_file_handler.expand_lab_directories([args.lab_files_directory] + (args.directory or []))
+    except ValueError as e:
+        print(e)
+        print('Arguement 1 must be the directory where only lab.txt files are located.')
+        sys.exit()
+    try:
+        # one connection and transaction is shared by every step; nothing is committed unless all steps succeed
+        sql = postgres_handler.SQL_Connector(connect_statement)
+    except Exception as e:
+        print(e)
+        print('Arguement 2 must be an SQL connection argument to your database.')
+        sys.exit()
+    cache = open_table_cache(args)
+    with sql:
+        # create new tables in database if they do not exist
+        with run_metrics.stage('create_lab_tables'):
+            lab_to_db_updater.create_lab_tables(sql)
         try:
-            # create new tables in database if they do not exist
-            lab_to_db_updater.create_lab_tables(connect_statement)
+            # add new lab records if they do not exist
+            with run_metrics.stage('add_new_lab_results'):
+                if args.shards:
+                    # the workers use their own connections, so they need to see the tables
+                    sql.commit()
+                    lab_to_db_updater.add_new_lab_results_sharded(connect_statement, lab_files_directories, args.shards,
+                                                                  chunk_size=args.chunk_size, workers=args.workers,
+                                                                  manifest_path=args.manifest)
+                else:
+                    # one manifest is shared by every directory so each directory's entries are kept
+                    manifest = ingestion_manifest.Ingestion_Manifest(args.manifest) if args.manifest else None
+                    for lab_files_directory in lab_files_directories:
+                        lab_to_db_updater.add_new_lab_results(sql, lab_files_directory,
+                                                              chunk_size=args.chunk_size, workers=args.workers,
+                                                              manifest_path=manifest,
+                                                              engine=args.ingest, queue_size=args.queue_size)
         except Exception as e:
             print(e)
-            print('Arguement 1 must be an SQL connection argument to your database.')
+            print('Arguement 1 must be the directory where only lab.txt files are located.')
             sys.exit()
+        # create the master csv
+        with run_metrics.stage('create_master_csv'):
+            csv_creater.create_master_csv(sql, engine=args.engine, state_path=args.master_state,
+                                          output_format=args.output_format, partition_by=args.partition_by,
+                                          table_cache=cache)
+
+# Seconds before a lab file that could not be added in watch mode is tried again
+watch_retry_delay = 30
+
+def watch(args):
+    """
+    Keeps adding lab files to the database as they arrive in the lab directory until interrupted (e.g., with Ctrl+C), using one connection for the whole time.
+
+    Every file in the directory is added first. After that, files reported by a lab_watcher.Lab_Directory_Watcher are added in small batches, each in its own transaction, and the master csv is recreated every master_interval seconds if records were added. A batch that fails is rolled back and reported, its files are added one at a time so one bad file does not hold back the rest, and watching carries on. Files that still cannot be added are tried again every watch_retry_delay seconds, up to args.retries times or until they change.
+    """
+    sql = postgres_handler.SQL_Connector(args.connect_statement)
+    manifest = ingestion_manifest.Ingestion_Manifest(args.manifest) if args.manifest else None
+    cache = open_table_cache(args)
+
+    # {lab file name : number of times it could not be added}
+    failures = {}
+
+    def try_add_lab_files(lab_filenames):
+        """
+        Adds lab files (every file in the directory if lab_filenames is None) in one transaction. Returns True if they were added, False if they were rolled back and None if the connection was lost.
+        """
         try:
-            # add new lab records if they do not exist
-            lab_to_db_updater.add_new_lab_results(connect_statement, lab_files_directory)
+            with run_metrics.stage('add_new_lab_results'):
+                lab_to_db_updater.add_new_lab_results(sql, args.lab_files_directory,
+                                                      chunk_size=args.chunk_size, workers=args.workers,
+                                                      manifest_path=manifest, lab_filenames=lab_filenames,
+                                                      engine=args.ingest, queue_size=args.queue_size)
+            sql.commit()
+            return True
         except Exception as e:
             print(e)
-            print('Arguement 2 must be the directory where only lab.txt files are located.')
-            sys.exit()
-        # create the master csv
-        csv_creater.create_master_csv(connect_statement)
-    else:
-        print("Please specify 2 arguements:")
-        print("1. The directory in quotes where only lab.txt files are located (e.g., 'lab_files/').")
-        print("2. A SQL connection argument to your database in quotes (e.g., 'dbname=citrine user=dale')")
+            if manifest:
+                manifest.discard_pending()
+            try:
+                sql.rollback()
+                return False
+            except Exception:
+                # the connection was lost
+                try:
+                    sql.reconnect()
+                except Exception as e:
+                    print(e)
+                return None
+
+    def add_lab_files(lab_filenames=None):
+        """
+        Adds lab files (every file in the directory if lab_filenames is None), returning True if any records may have been added. If the files cannot be added together, each is added on its own; files that still cannot be added are given back to the watcher to be tried again later.
+        """
+        result = try_add_lab_files(lab_filenames)
+        if lab_filenames is None:
+            if result:
+                return True
+            lab_filenames = sorted(file_name for file_name in os.listdir(args.lab_files_directory) if file_name[-4:] == '.txt')
+        elif result:
+            for file_name in lab_filenames:
+                failures.pop(file_name, None)
+            return True
+
+        added = False
+        failed = lab_filenames
+        if result is False and len(lab_filenames) > 1:
+            failed = []
+            for i, file_name in enumerate(lab_filenames):
+                file_result = try_add_lab_files([file_name])
+                if file_result:
+                    added = True
+                    failures.pop(file_name, None)
+                    continue
+                failed.append(file_name)
+                if file_result is None:
+                    # the connection was lost; try the remaining files later rather than one at a time now
+                    failed += lab_filenames[i + 1:]
+                    break
+
+        retry_filenames = []
+        for file_name in failed:
+            failures[file_name] = failures.get(file_name, 0) + 1
+            if failures[file_name] > args.retries:
+                print('Could not add', file_name + '; it will be tried again if it changes')
+                del failures[file_name]
+            else:
+                retry_filenames.append(file_name)
+        watcher.retry(retry_filenames, delay=watch_retry_delay)
+        return added
+
+    def create_master_csv():
+        try:
+            with run_metrics.stage('create_master_csv'):
+                csv_creater.create_master_csv(sql, engine=args.engine, state_path=args.master_state,
+                                              output_format=args.output_format, partition_by=args.partition_by,
+                                              table_cache=cache)
+            sql.commit()
+        except Exception as e:
+            print(e)
+            try:
+                sql.rollback()
+            except Exception:
+                sql.reconnect()
+
+    # start watching before adding the files already there so none are missed in between
+    with lab_watcher.Lab_Directory_Watcher(args.lab_files_directory, debounce=args.debounce, poll_interval=args.poll_interval,
+                                           max_batch=args.chunk_size) as watcher:
+        lab_to_db_updater.create_lab_tables(sql)
+        sql.commit()
+        add_lab_files()
+        create_master_csv()
+        last_master = time.monotonic()
+        records_since_master = False
+        print('Watching', args.lab_files_directory, 'for new lab files')
+        try:
+            while True:
+                lab_filenames = watcher.next_batch(timeout=max(0, last_master + args.master_interval - time.monotonic()))
+                if lab_filenames and add_lab_files(lab_filenames):
+                    records_since_master = True
+                if time.monotonic() - last_master >= args.master_interval:
+                    if records_since_master:
+                        create_master_csv()
+                        records_since_master = False
+                    last_master = time.monotonic()
+        except KeyboardInterrupt:
+            print('Stopped watching')
+        finally:
+            if records_since_master:
+                create_master_csv()
+            sql.disconnect()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Upload lab result files to the database and create a master csv.")
+    parser.add_argument('lab_files_directory',
+                        help="The directory where only lab.txt files are located (e.g., 'lab_files/').")
+    parser.add_argument('connect_statement',
+                        help="A SQL connection argument to your database (e.g., 'dbname=citrine user=dale').")
+    parser.add_argument('--directory', action='append', default=None,
+                        help="Another directory (or glob pattern matching directories, e.g., 'drops/*/') of lab files to add. Can be given more than once. The first argument may also be a glob pattern.")
+    parser.add_argument('--measurements', default=None,
+                        help="Directory of measurement json files describing the types of lab file to add (default: the measurements directory).")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Add lab records with this many worker processes, each with its own connection and committing its records in batches, sending each record to a worker by a hash of its material_uid.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker processes used to parse lab files (default: parse in this process).")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="Number of lab files parsed and uploaded at a time (default: 1000).")
+    parser.add_argument('--manifest', default=None,
+                        help="Path of an ingestion manifest (json) used to skip lab files added on earlier runs.")
+    parser.add_argument('--ingest', choices=['sync', 'async'], default='sync',
+                        help="Add lab files one chunk at a time (default) or parse the next chunks while earlier ones are added to the database.")
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help="With --ingest async, the number of parsed chunks of each measurement waiting to be added (default: 2).")
+    parser.add_argument('--engine', choices=['pandas', 'sql'], default='pandas',
+                        help="Build the master csv with pandas merges (default) or with a single query in the database.")
+    parser.add_argument('--master-state', default=None,
+                        help="Path of a master csv state (json) used to patch the previous master csv instead of rebuilding it.")
+    parser.add_argument('--table-cache', default='.table_cache',
+                        help="Directory of snapshots of the tables used to build the master csv with --engine pandas; tables that have not changed since an earlier build are loaded from it instead of the database (default: .table_cache). Needs the pyarrow library.")
+    parser.add_argument('--table-cache-size', type=int, default=1024,
+                        help="Size in MB the table cache is kept under by removing the least recently used snapshots (default: 1024).")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Collect every table from the database without using or updating the table cache.")
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'arrow'], default='csv',
+                        help="Write the master file as a csv (default), a Parquet file or an Arrow IPC file.")
+    parser.add_argument('--partition-by', nargs='+', default=None,
+                        help="Master columns to partition parquet or arrow output by (e.g., hot_press_process_name).")
+    parser.add_argument('--metrics', default=None,
+                        help="Path to write a report of the time spent in each stage and the files, records, rows and queries counted.")
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                        help="Write the metrics report as json (default) or in the Prometheus text format (e.g., for the node exporter textfile collector).")
+    parser.add_argument('--query-histogram', action='store_true',
+                        help="Include a histogram of database query latencies in the metrics report.")
+    parser.add_argument('--profile', default=None,
+                        help="Path to save cProfile statistics of the run to (the slowest functions are also printed).")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running, adding lab files to the database as they arrive in the directory.")
+    parser.add_argument('--master-interval', type=float, default=300,
+                        help="With --watch, the number of seconds between recreating the master csv if records were added (default: 300).")
+    parser.add_argument('--retries', type=int, default=3,
+                        help="With --watch, the number of times a lab file that could not be added is tried again, every 30 seconds (default: 3).")
+    parser.add_argument('--debounce', type=float, default=0.2,
+                        help="With --watch, the number of seconds a new lab file has to go unchanged before it is added (default: 0.2).")
+    parser.add_argument('--poll-interval', type=float, default=0.5,
+                        help="With --watch, the number of seconds between listings of the directory if inotify (the watchdog library) is not available (default: 0.5).")
+    args = parser.parse_args()
+    if args.measurements:
+        measurement_registry.use_directory(args.measurements)
+
+    metrics = run_metrics.Run_Metrics(query_histogram=args.query_histogram)
+    metrics.start()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.enable()
+        if args.watch:
+            watch(args)
+        else:
+            run(args)
+    finally:
+        # report even if the run failed, so slow or failed runs can be looked into
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        metrics.stop()
+        if args.metrics:
+            if args.metrics_format == 'prometheus':
+                metrics.write_prometheus(args.metrics)
+            else:
+                metrics.write_json(args.metrics)
@@ -1,14 +1,49 @@
-import pandas as pd
+import csv
 import datetime
+import heapq
+import os
+
+from psycopg2 import sql as psycopg2_sql
 
 import postgres_handler
-from lab_to_db_updater import measurement_types
+import master_csv_state
+import run_metrics
+import measurement_registry
 
 sql_materials_table_name = "material_procurement"
 sql_ball_milling_table_name = "ball_milling"
 sql_hot_press_table_name = "hot_press"
 
-def create_master_csv(connect_statement):
+# Columns used to join the tables
+ball_milling_hot_press_column = 'hot_press_uid'
+hot_press_uid_column = 'uid'
+materials_ball_milling_column = 'ball_milling_uid'
+material_type_column = 'material_name'
+process_output_material_column = 'output_material_uid'
+
+# Rename columns with names in multiple tables
+ball_milling_column_renames = {'process_name' : 'ball_milling_process_name',
+                               'output_material_name' : 'ball_milling_output_material_name',
+                               'output_material_uid': 'ball_milling_output_material_uid'}
+hot_press_column_renames = {'process_name' : 'hot_press_process_name',
+                            'output_material_name' : 'hot_press_output_material_name',
+                            'output_material_uid': 'hot_press_output_material_uid'}
+# Suffixes for any remaining columns in both tables
+ball_milling_suffix = '_ball_milling'
+hot_press_suffix = '_hot_press'
+# Rename and drop duplicative columns once ball milling and hot press are merged
+master_column_renames = {'uid_ball_milling' : 'ball_milling_uid'}
+master_dropped_columns = ['uid_hot_press']
+
+# Columns with few distinct values that are collected as categoricals (see collect_table_dataframe)
+categorical_columns = ['measurement', 'gas_type', 'material_name']
+
+# List of processes to search for lab results for their output materials
+# [(processes_abreviation, process_output_material_uid_column_name)]
+processes = [('bm', 'ball_milling_output_material_uid'),
+            ('hp', 'hot_press_output_material_uid')]
+
+def create_master_csv(connect_statement, engine='pandas', state_path=None, output_format='csv', partition_by=None, table_cache=None):
     """
     This creates a master csv file by pulling data from the database and the recently loaded lab result files. It assumes that uid is unique in each table.
 
@@ -19,69 +54,199 @@ def create_master_csv(connect_statement):
     The likelist point of failure would be any changes to the database such as names of tables or names of columns.
 
     Any updates or additional lab result measurment files will have to be addressed both here and in the lab_to_db_updater.py file.
+
+    connect_statement may also be an SQL_Connector so that the master csv is made within the same connection and transaction as the other steps (see postgres_handler.use_connection).
+
+    engine is either 'pandas', which collects each table and merges them with pandas, or 'sql', which has the database do the joins in one query and streams the result straight to the csv (see write_master_csv_sql). Both create the same file; 'sql' does not need to hold the tables in memory.
+
+    If state_path is given, the previous master csv is patched instead of being rebuilt: only the rows affected by changes to the database since it was made are recreated (see update_master_csv). The state is kept in a json file at state_path (see master_csv_state.py). The rows are always made with the 'sql' engine's query in this case.
+
+    output_format is the name of a writer in output_writers: 'csv' (the default), 'parquet' or 'arrow' (Arrow IPC). The columnar formats keep each column's dtype and dictionary encode string columns so that selected columns can be loaded without parsing text (see write_master_parquet and write_master_arrow). partition_by is an optional list of master columns (e.g., ['hot_press_process_name']) to split columnar output into a directory with one partition per value.
+
+    table_cache is an optional table_cache.Table_Cache used by the 'pandas' engine to keep snapshots of the tables it collects, so tables that have not changed since an earlier build are loaded from local files instead of the database (see collect_table_dataframe).
     """
-    # Connect to SQL database
-    sql = postgres_handler.SQL_Connector(connect_statement)
+    if engine not in ('pandas', 'sql'):
+        raise ValueError(f"engine must be 'pandas' or 'sql', not {engine}")
+    if output_format not in output_writers:
+        raise ValueError(f"output_format must be one of {list(output_writers)}, not {output_format}")
+    if output_format != 'csv' and state_path:
+        raise ValueError("Only csv output can be patched with a master csv state")
+    if output_format == 'csv' and partition_by:
+        raise ValueError("Only parquet and arrow output can be partitioned")
+
+    name_of_output = master_csv_name(output_writers[output_format]['extension'])
 
+    # Connect to SQL database (or use the connection already given)
+    with postgres_handler.use_connection(connect_statement) as sql:
+        if state_path:
+            update_master_csv(sql, name_of_output, state_path)
+        elif engine == 'sql' and output_format == 'csv':
+            with run_metrics.stage('write_master'):
+                write_master_csv_sql(sql, name_of_output)
+        else:
+            # Create output file
+            if engine == 'sql':
+                sql_df = build_master_dataframe_sql(sql)
+            else:
+                sql_df = build_master_dataframe(sql, table_cache)
+            with run_metrics.stage('write_master'):
+                output_writers[output_format]['writer'](sql_df, name_of_output, partition_by)
+            run_metrics.count('master_rows', len(sql_df))
+    print('Created new master ' + output_format + ':', name_of_output)
+
+def build_master_dataframe(sql, table_cache=None):
+    """
+    Collects the process, materials and lab tables (from table_cache where they have not changed) and merges them with pandas into the master DataFrame (see create_master_csv).
+    """
     # Collect existing tables
-    material_procurement = sql.collect_all_table_records(sql_materials_table_name)
-    material_procurement = pd.DataFrame(material_procurement[0], columns=material_procurement[1])
-    ball_milling = sql.collect_all_table_records(sql_ball_milling_table_name)
-    ball_milling = pd.DataFrame(ball_milling[0], columns=ball_milling[1])
-    hot_press = sql.collect_all_table_records(sql_hot_press_table_name)
-    hot_press = pd.DataFrame(hot_press[0], columns=hot_press[1])
+    material_procurement = collect_table_dataframe(sql, sql_materials_table_name, table_cache=table_cache)
+    ball_milling = collect_table_dataframe(sql, sql_ball_milling_table_name, table_cache=table_cache)
+    hot_press = collect_table_dataframe(sql, sql_hot_press_table_name, table_cache=table_cache)
 
     # Rename columns with names in multiple tables
-    ball_milling.rename(columns={'process_name' : 'ball_milling_process_name',
-                             'output_material_name' : 'ball_milling_output_material_name',
-                             'output_material_uid': 'ball_milling_output_material_uid'}, inplace=True)
-    hot_press.rename(columns={'process_name' : 'hot_press_process_name',
-                             'output_material_name' : 'hot_press_output_material_name',
-                             'output_material_uid': 'hot_press_output_material_uid'}, inplace=True)
+    ball_milling.rename(columns=ball_milling_column_renames, inplace=True)
+    hot_press.rename(columns=hot_press_column_renames, inplace=True)
 
     # Merge ball milling and hot press tables
-    sql_df = ball_milling.merge(hot_press,
-                                how='outer',
-                                left_on='hot_press_uid',
-                                right_on='uid',
-                                suffixes=('_ball_milling', '_hot_press'))
+    with run_metrics.stage('merge_tables'):
+        sql_df = ball_milling.merge(hot_press,
+                                    how='outer',
+                                    left_on=ball_milling_hot_press_column,
+                                    right_on=hot_press_uid_column,
+                                    suffixes=(ball_milling_suffix, hot_press_suffix))
+        # Order rows as build_master_query does: by join key and then ball milling uid, with missing values last. pandas keeps rows with the same join key in table order, which is not fixed.
+        sql_df['_sort_key'] = sql_df[ball_milling_hot_press_column].fillna(sql_df[hot_press_uid_column + hot_press_suffix])
+        sql_df = (sql_df.sort_values(['_sort_key', hot_press_uid_column + ball_milling_suffix], na_position='last', kind='mergesort')
+                  .drop(columns='_sort_key')
+                  .reset_index(drop=True))
 
     sql_df = split_and_merge_materials(merge_df=sql_df,
                                        materials_df=material_procurement,
-                                       merge_df_column_to_merge_on='uid_ball_milling',
-                                       materials_df_column_to_merge_on='ball_milling_uid',
-                                       material_type_column_name='material_name')
+                                       merge_df_column_to_merge_on=hot_press_uid_column + ball_milling_suffix,
+                                       materials_df_column_to_merge_on=materials_ball_milling_column,
+                                       material_type_column_name=material_type_column)
 
     # Rename and drop duplicative columns
     try:
-        sql_df.rename(columns={'uid_ball_milling' : 'ball_milling_uid'}, inplace=True)
-        sql_df = sql_df.drop(['uid_hot_press'], axis=1)
+        sql_df.rename(columns=master_column_renames, inplace=True)
+        sql_df = sql_df.drop(master_dropped_columns, axis=1)
     except:
         # Prevents failure due to column names not existing; code will work, but nameing my be confusing
         pass
 
-    # List of processes to search for lab results for their output materials
-    # [(processes_abreviation, process_output_material_uid_column_name)]
-    processes = [('bm', 'ball_milling_output_material_uid'),
-                ('hp', 'hot_press_output_material_uid')]
+    # Loop through measurements (as defined in the measurements directory; see measurement_registry) and add them to the csv
+    for measurement in measurement_registry.measurement_types():
+        sql_df = add_lab_results(sql, sql_df, measurement, processes, table_cache)
+    return sql_df
 
-    # Loop through measurements (as defined in lab_to_db_updater file) and add them to the csv
-    for measurement in measurement_types:
-        sql_df = add_lab_results(sql, sql_df, measurement, processes)
+def build_master_dataframe_sql(sql, itersize=2000):
+    """
+    Collects the master DataFrame with the query used by write_master_csv_sql (see build_master_query), itersize rows at a time, for output formats that are not streamed straight to a file.
+    """
+    import pandas as pd
 
+    query, column_names = build_master_query(sql)
+    with run_metrics.stage('query_master'):
+        chunks = [pd.DataFrame.from_records(rows, columns=column_names) for rows in sql.stream_query(query, itersize=itersize)]
+    if not chunks:
+        return pd.DataFrame(columns=column_names)
+    return pd.concat(chunks, ignore_index=True)
+
+def master_csv_name(extension='csv'):
+    """
+    Returns the file name of the master csv (or other output format with the given file extension) using today's date.
+    """
     # Collect today's date
     now = datetime.datetime.now(datetime.timezone.utc)
     today = str(now.year) + '-' + str(now.month) + '-' + str(now.day)
+    return 'master_' + today + '.' + extension
+
+def collect_table_dataframe(sql, table_name, itersize=2000, table_cache=None):
+    """
+    Collects table table_name into a DataFrame, itersize rows at a time from a server side cursor (see SQL_Connector.iter_table_records), so that the full table is never held as a list of tuples as well as a DataFrame.
+
+    Columns are given compact dtypes as each chunk arrives: real columns are float32 and columns in categorical_columns are categoricals. Neither changes how values are written to the csv.
+
+    If table_cache is given, the table's version is checked first (see SQL_Connector.collect_table_version) and a snapshot of the same version is loaded instead of collecting the table; otherwise the collected table is stored in the cache for next time.
+    """
+    import pandas as pd
+
+    column_types = sql.collect_table_column_types(table_name)
+    column_names = [name for name, data_type in column_types]
+    dtypes = {}
+    for name, data_type in column_types:
+        if data_type == 'real':
+            dtypes[name] = 'float32'
+        elif name in categorical_columns:
+            dtypes[name] = 'category'
+
+    if table_cache is not None:
+        with run_metrics.stage('load_cached_tables'):
+            cache_key = [table_name, column_types, dtypes, sql.collect_table_version(table_name)]
+            table_df = table_cache.load(cache_key)
+        if table_df is not None:
+            run_metrics.count('table_cache_hits')
+            return table_df
+        run_metrics.count('table_cache_misses')
+
+    with run_metrics.stage('collect_tables'):
+        chunks = [pd.DataFrame.from_records(rows, columns=column_names).astype(dtypes)
+                  for rows in sql.iter_table_records(table_name, itersize)]
+    run_metrics.count('table_rows_collected', sum(len(chunk) for chunk in chunks))
+    if not chunks:
+        table_df = pd.DataFrame(columns=column_names).astype(dtypes)
+    else:
+        # Give every chunk the same categories so they remain categoricals once concatenated
+        for name, dtype in dtypes.items():
+            if dtype == 'category':
+                categories = pd.Index([])
+                for chunk in chunks:
+                    categories = categories.append(chunk[name].cat.categories.difference(categories))
+                for chunk in chunks:
+                    chunk[name] = chunk[name].cat.set_categories(categories)
+        table_df = pd.concat(chunks, ignore_index=True)
 
-    # Create csv file
-    name_of_output = 'master_' + today + '.csv'
-    sql_df.to_csv(name_of_output)
-    print('Created new master csv:', name_of_output)
+    if table_cache is not None:
+        with run_metrics.stage('store_cached_tables'):
+            table_cache.store(cache_key, table_df)
+    return table_df
 
 def split_and_merge_materials(merge_df, materials_df, merge_df_column_to_merge_on, materials_df_column_to_merge_on, material_type_column_name):
     """
     Helper function to dynamically create columns based on however many materials are used in processes.
 
+    The materials are pivoted into one wide table with a row per process and a set of columns per material (named material + '_' + column, in the order the materials first appear) and merged in once, so the time taken does not grow with the number of materials times the size of merge_df. If a material appears more than once for a process only the first is used, as with the 'sql' engine.
+    """
+    import pandas as pd
+
+    materials_df = materials_df[materials_df[material_type_column_name].notnull()]
+    if materials_df.empty:
+        return merge_df
+    materials_df = materials_df.drop_duplicates([materials_df_column_to_merge_on, material_type_column_name])
+    material_names = materials_df[material_type_column_name].astype(object).unique()
+    value_columns = [column for column in materials_df.columns if column != materials_df_column_to_merge_on]
+
+    with run_metrics.stage('merge_tables'):
+        # One row per process with a (column, material) pair of columns for each material
+        index = pd.MultiIndex.from_arrays([materials_df[materials_df_column_to_merge_on].astype(object),
+                                           materials_df[material_type_column_name].astype(object)])
+        wide_df = materials_df[value_columns].set_axis(index, axis=0).unstack()
+        wide_df = wide_df.reindex(columns=pd.MultiIndex.from_tuples([(column, material) for material in material_names for column in value_columns]))
+        wide_df.columns = [str(material) + '_' + column for column, material in wide_df.columns]
+
+        # Merge on a column rather than the index so merge_df keeps its own index
+        key_column = '_' + materials_df_column_to_merge_on
+        wide_df.index.name = key_column
+        merge_df = merge_df.merge(wide_df.reset_index(),
+                                  how='left',
+                                  left_on=merge_df_column_to_merge_on,
+                                  right_on=key_column)
+        merge_df.drop(key_column, axis=1, inplace=True)
+    return merge_df
+
+def split_and_merge_materials_loop(merge_df, materials_df, merge_df_column_to_merge_on, materials_df_column_to_merge_on, material_type_column_name):
+    """
+    The original version of split_and_merge_materials, merging merge_df with each material in turn. Each merge copies the growing merge_df, so this slows down quickly as materials are added; split_and_merge_materials should be preferred. It is kept for comparison (see benchmark.py).
     """
     for material in materials_df[material_type_column_name].unique():
         temp_df = materials_df[materials_df[material_type_column_name] == material]
@@ -93,7 +258,7 @@ def split_and_merge_materials(merge_df, materials_df, merge_df_column_to_merge_o
         merge_df.drop(material + '_' + materials_df_column_to_merge_on, axis=1, inplace=True)
     return merge_df
 
-def add_lab_results(sql, merge_df, measurement, processes):
+def add_lab_results(sql, merge_df, measurement, processes, table_cache=None):
     """
     Helper function to allow additional lab results measurement types to be added to master.
 
@@ -102,24 +267,359 @@ def add_lab_results(sql, merge_df, measurement, processes):
                   {'sql_table_name' : sql_table_name , 'sql_unique_id_column_name' : sql_unique_id_column_name}
     processes = list of processes to check for lab results
                 [(processes_abreviation, process_output_material_uid_column_name)]
+    table_cache = optional table_cache.Table_Cache the lab table is loaded from or stored in (see collect_table_dataframe)
+
+    Lab results are looked up by their unique id for each process and all of their columns are added to merge_df at once, rather than merging merge_df with the lab table once per process. Each material is expected to have one lab result per measurement (see lab_to_db_updater.add_new_lab_results); if not, only the first is used.
     """
-    # Collect new lab result tables
-    lab_table = sql.collect_all_table_records(measurement['sql_table_name'])
-    lab_table = pd.DataFrame(lab_table[0], columns=lab_table[1])
+    import pandas as pd
+
+    # Collect new lab result tables, indexed by their unique id
+    lab_table = collect_table_dataframe(sql, measurement['sql_table_name'], table_cache=table_cache)
+    lab_table = lab_table.drop_duplicates(measurement['sql_unique_id_column_name']).set_index(measurement['sql_unique_id_column_name'])
 
     # Loop through provided processes to search for matching lab results
-    for process in processes:
-        # Create naming for columns and mergeing
-        prefix = process[0]+'_'+measurement['sql_table_name']+'_'
-        new_unique_column = prefix + measurement['sql_unique_id_column_name']
-
-        # Merge lab results by process_output_material_uid_column_name
-        merge_df = merge_df.merge(lab_table.add_prefix(prefix),
-                                    how='left',
-                                    left_on=process[1],
-                                    right_on=new_unique_column)
-
-        # Create some columns for easy identifying where measurments exist and drop duplicate column
-        merge_df[prefix + 'results'] = merge_df[new_unique_column].notnull()
-        merge_df.drop(new_unique_column, axis=1, inplace=True)
+    process_lab_tables = []
+    with run_metrics.stage('merge_tables'):
+        for process in processes:
+            # Create naming for columns
+            prefix = process[0]+'_'+measurement['sql_table_name']+'_'
+
+            # Look up lab results by process_output_material_uid_column_name
+            process_lab_table = lab_table.reindex(merge_df[process[1]].values).add_prefix(prefix)
+            process_lab_table.index = merge_df.index
+
+            # Create some columns for easy identifying where measurments exist
+            process_lab_table[prefix + 'results'] = merge_df[process[1]].isin(lab_table.index).values
+            process_lab_tables.append(process_lab_table)
+        merge_df = pd.concat([merge_df] + process_lab_tables, axis=1)
     return merge_df
+
+def write_master_csv_sql(sql, output_path, itersize=2000):
+    """
+    Writes the master csv to output_path using a single query (see build_master_query) instead of collecting every table and merging them with pandas.
+
+    Rows are streamed from a server side cursor itersize rows at a time and written as they arrive, so memory use does not depend on the size of the database. Values are written the way pandas writes them (blank for missing values, the row number as an unnamed first column) so the file matches the one create_master_csv makes with the pandas engine.
+    """
+    query, column_names = build_master_query(sql)
+    with open(output_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        writer.writerow([''] + column_names)
+        index = 0
+        for rows in sql.stream_query(query, itersize=itersize):
+            for row in rows:
+                writer.writerow((index,) + row)
+                index += 1
+    run_metrics.count('master_rows', index)
+
+def update_master_csv(sql, output_path, state_path, itersize=2000):
+    """
+    Writes the master csv to output_path by patching the previous master csv recorded in the state at state_path (see master_csv_state.py), falling back to writing the whole file if there is no previous master csv or its columns have changed (e.g., a new material).
+
+    The tables are fingerprinted in the database (see SQL_Connector.collect_row_fingerprints) and compared with the fingerprints recorded when the previous master csv was made to find the ball milling and hot press processes whose rows have changed (see find_changed_processes). Only those rows are queried (see build_master_query); every other row is copied from the previous master csv as it was written. The file is written the same way as write_master_csv_sql, so it matches the file made from scratch.
+
+    The state is saved as soon as the master csv is written. If the transaction is later rolled back, the next run will find the rolled back changes as differences and recreate the rows they affected.
+    """
+    state = master_csv_state.Master_CSV_State(state_path)
+    with run_metrics.stage('fingerprint_tables'):
+        fingerprints = collect_master_fingerprints(sql)
+    query, column_names = build_master_query(sql, row_keys=True)
+
+    if not state.can_patch(column_names) or len(state.row_keys) != count_csv_rows(state.master_path):
+        # Write the whole master csv, recording the keys of each row
+        row_keys = []
+        with run_metrics.stage('write_master'), open(output_path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file, lineterminator=os.linesep)
+            writer.writerow([''] + column_names)
+            for rows in sql.stream_query(query, itersize=itersize):
+                for row in rows:
+                    writer.writerow((len(row_keys),) + row[:-3])
+                    row_keys.append(list(row[-3:]))
+        run_metrics.count('master_rows', len(row_keys))
+        state.save(output_path, column_names, fingerprints, row_keys)
+        print('Master csv rebuilt;', len(row_keys), 'rows written')
+        return
+
+    with run_metrics.stage('find_changed_processes'):
+        ball_milling_uids, hot_press_uids = find_changed_processes(sql, state, fingerprints)
+    if not ball_milling_uids and not hot_press_uids and os.path.abspath(state.master_path) == os.path.abspath(output_path):
+        print('Master csv is up to date')
+        return
+
+    # Recreate the rows of the changed processes
+    query, column_names = build_master_query(sql, ball_milling_uids, hot_press_uids, row_keys=True)
+    with run_metrics.stage('query_master'):
+        new_rows = [(row_sort_key(row[-3:]), list(row[-3:]), row[:-3])
+                    for rows in sql.stream_query(query, itersize=itersize) for row in rows]
+    new_rows.sort(key=lambda new_row: new_row[0])
+
+    def kept_rows(reader):
+        # rows of the previous master csv that are not being recreated, without their row numbers
+        for row_key, row in zip(state.row_keys, reader):
+            ball_milling_uid, hot_press_uid = row_key[0], row_key[1]
+            if ball_milling_uid in ball_milling_uids or (ball_milling_uid is None and hot_press_uid in hot_press_uids):
+                continue
+            yield row_sort_key(row_key), row_key, row[1:]
+
+    # Merge the kept and recreated rows in order; write to a temporary file as output_path may be the previous master csv
+    row_keys = []
+    temp_path = output_path + '.tmp'
+    with run_metrics.stage('write_master'), \
+         open(state.master_path, 'r', newline='', encoding='utf-8') as previous_file, \
+         open(temp_path, 'w', newline='', encoding='utf-8') as file:
+        reader = csv.reader(previous_file)
+        next(reader)
+        writer = csv.writer(file, lineterminator=os.linesep)
+        writer.writerow([''] + column_names)
+        for sort_key, row_key, row in heapq.merge(kept_rows(reader), new_rows, key=lambda merged_row: merged_row[0]):
+            writer.writerow([len(row_keys)] + list(row))
+            row_keys.append(row_key)
+    os.replace(temp_path, output_path)
+    run_metrics.count('master_rows', len(row_keys))
+    run_metrics.count('master_rows_recreated', len(new_rows))
+    state.save(output_path, column_names, fingerprints, row_keys)
+    print('Master csv patched;', len(new_rows), 'of', len(row_keys), 'rows recreated')
+
+def collect_master_fingerprints(sql):
+    """
+    Returns dictionary {table name : {key : md5 hash}} fingerprinting every table used by the master csv (see SQL_Connector.collect_row_fingerprints). Processes are keyed by their uid, materials by their ball milling uid and lab results by their unique id column.
+    """
+    fingerprint_keys = [(sql_ball_milling_table_name, hot_press_uid_column),
+                        (sql_hot_press_table_name, hot_press_uid_column),
+                        (sql_materials_table_name, materials_ball_milling_column)]
+    fingerprint_keys += [(measurement['sql_table_name'], measurement['sql_unique_id_column_name']) for measurement in measurement_registry.measurement_types()]
+    return {table_name : sql.collect_row_fingerprints(table_name, key_column) for table_name, key_column in fingerprint_keys}
+
+def find_changed_processes(sql, state, fingerprints):
+    """
+    Returns the sets of ball milling uids and hot press uids whose master csv rows need to be recreated, comparing fingerprints with those recorded in state.
+
+    A ball milling process has changed if its row, its materials or the lab results for its output material have been added, changed or removed; a hot press process if its row or the lab results for its output material have. Hot press processes previously joined to a changed ball milling process are included so they are recreated on their own if nothing joins them anymore, and ball milling processes joined to a changed hot press process are included so their rows are recreated with it.
+    """
+    def changed_keys(table_name):
+        previous, current = state.fingerprints.get(table_name, {}), fingerprints[table_name]
+        return {key for key in previous.keys() | current.keys() if previous.get(key) != current.get(key)}
+
+    ball_milling_uids = changed_keys(sql_ball_milling_table_name) | changed_keys(sql_materials_table_name)
+    hot_press_uids = changed_keys(sql_hot_press_table_name)
+
+    # Processes with changed lab results for their output materials
+    lab_material_uids = set()
+    for measurement in measurement_registry.measurement_types():
+        lab_material_uids |= changed_keys(measurement['sql_table_name'])
+    if lab_material_uids:
+        ball_milling_uids.update(row[0] for row in sql.collect_rows_matching_any(sql_ball_milling_table_name, [hot_press_uid_column],
+                                                                                 {process_output_material_column : lab_material_uids}))
+        hot_press_uids.update(row[0] for row in sql.collect_rows_matching_any(sql_hot_press_table_name, [hot_press_uid_column],
+                                                                              {process_output_material_column : lab_material_uids}))
+
+    # Hot press processes previously joined to changed ball milling processes
+    for ball_milling_uid, hot_press_uid, sort_key in state.row_keys:
+        if ball_milling_uid in ball_milling_uids and hot_press_uid is not None:
+            hot_press_uids.add(hot_press_uid)
+
+    # Ball milling processes joined to changed hot press processes, and hot press processes now joined to changed ball milling processes
+    for ball_milling_uid, hot_press_uid in sql.collect_rows_matching_any(sql_ball_milling_table_name,
+                                                                         [hot_press_uid_column, ball_milling_hot_press_column],
+                                                                         {hot_press_uid_column : ball_milling_uids,
+                                                                          ball_milling_hot_press_column : hot_press_uids}):
+        ball_milling_uids.add(ball_milling_uid)
+        if hot_press_uid is not None:
+            hot_press_uids.add(hot_press_uid)
+    return ball_milling_uids, hot_press_uids
+
+def row_sort_key(row_key):
+    """
+    Returns a key to sort master csv rows by from their [ball milling uid, hot press uid, sort key]. Rows are ordered as write_master_csv_sql orders them: by the sort key and then by ball milling uid, with rows without either last.
+    """
+    return (row_key[2] is None, row_key[2] or '', row_key[0] is None, row_key[0] or '')
+
+def count_csv_rows(csv_path):
+    """
+    Returns the number of rows in a csv file, not counting the header.
+    """
+    with open(csv_path, 'r', newline='', encoding='utf-8') as file:
+        return sum(1 for row in csv.reader(file)) - 1
+
+def build_master_query(sql, ball_milling_uids=None, hot_press_uids=None, row_keys=False):
+    """
+    Builds the query used by write_master_csv_sql. Returns the query and the list of master csv column names in the same order as the columns it selects.
+
+    The query mirrors the pandas merges in create_master_csv:
+    ball milling and hot press are fully outer joined,
+    each material in the material_procurement table becomes a set of columns using conditional aggregation (one row per ball milling process; if a material appears more than once for a process only one of them is used),
+    and each process is left joined to each lab table on its output material.
+    Rows are ordered by the ball milling/hot press join key as pandas does for outer merges, then by ball milling uid so that rows with the same join key (e.g., ball milling processes without a hot press) are always in the same order (see row_sort_key).
+
+    If ball_milling_uids and hot_press_uids are given, only those ball milling and hot press processes are joined (see update_master_csv). If row_keys is True, the ball milling uid, hot press uid and the key rows are ordered by are selected after the master csv columns (they are not included in the column names).
+    """
+    ball_milling_columns = sql.collect_table_column_names(sql_ball_milling_table_name)
+    hot_press_columns = sql.collect_table_column_names(sql_hot_press_table_name)
+    materials_columns = sql.collect_table_column_names(sql_materials_table_name)
+
+    # Name ball milling and hot press columns as the pandas merge does
+    ball_milling_names = [ball_milling_column_renames.get(column, column) for column in ball_milling_columns]
+    hot_press_names = [hot_press_column_renames.get(column, column) for column in hot_press_columns]
+    overlapping_names = set(ball_milling_names) & set(hot_press_names)
+
+    # [(master column name, sql expression)]
+    select_columns = []
+    for table_alias, columns, names, suffix in [('bm', ball_milling_columns, ball_milling_names, ball_milling_suffix),
+                                               ('hp', hot_press_columns, hot_press_names, hot_press_suffix)]:
+        for column, name in zip(columns, names):
+            if name in overlapping_names:
+                name = name + suffix
+            if name in master_dropped_columns:
+                continue
+            select_columns.append((master_column_renames.get(name, name), psycopg2_sql.Identifier(table_alias, column)))
+
+    # Collect material names in the order they appear in the table
+    materials = []
+    material_names_query = psycopg2_sql.SQL("SELECT {} FROM {};").format(psycopg2_sql.Identifier(material_type_column),
+                                                                       psycopg2_sql.Identifier(sql_materials_table_name))
+    for rows in sql.stream_query(material_names_query):
+        for (material,) in rows:
+            if material is not None and material not in materials:
+                materials.append(material)
+
+    # Pivot materials into columns with one aggregate per material and column
+    material_aggregates = []
+    for material in materials:
+        for column in materials_columns:
+            if column == materials_ball_milling_column:
+                continue
+            alias = 'm' + str(len(material_aggregates))
+            material_aggregates.append(psycopg2_sql.SQL("(array_agg({column}) FILTER (WHERE {type_column} = {material}))[1] AS {alias}")
+                                       .format(column=psycopg2_sql.Identifier(column),
+                                               type_column=psycopg2_sql.Identifier(material_type_column),
+                                               material=psycopg2_sql.Literal(material),
+                                               alias=psycopg2_sql.Identifier(alias)))
+            select_columns.append((str(material) + '_' + column, psycopg2_sql.Identifier('materials', alias)))
+
+    # Join each process to each lab table on its output material
+    column_expressions = dict(select_columns)
+    lab_joins = []
+    for measurement in measurement_registry.measurement_types():
+        lab_columns = sql.collect_table_column_names(measurement['sql_table_name'])
+        unique_column = measurement['sql_unique_id_column_name']
+        for process in processes:
+            table_alias = process[0] + '_' + measurement['sql_table_name']
+            lab_joins.append(psycopg2_sql.SQL("LEFT JOIN {table} AS {alias} ON {alias_unique_column} = {process_column}")
+                             .format(table=psycopg2_sql.Identifier(measurement['sql_table_name']),
+                                     alias=psycopg2_sql.Identifier(table_alias),
+                                     alias_unique_column=psycopg2_sql.Identifier(table_alias, unique_column),
+                                     process_column=column_expressions[process[1]]))
+            for column in lab_columns:
+                if column != unique_column:
+                    select_columns.append((table_alias + '_' + column, psycopg2_sql.Identifier(table_alias, column)))
+            select_columns.append((table_alias + '_results',
+                                   psycopg2_sql.SQL("{} IS NOT NULL").format(psycopg2_sql.Identifier(table_alias, unique_column))))
+
+    # Only join the given processes
+    ball_milling_table = psycopg2_sql.Identifier(sql_ball_milling_table_name)
+    hot_press_table = psycopg2_sql.Identifier(sql_hot_press_table_name)
+    materials_table = psycopg2_sql.Identifier(sql_materials_table_name)
+    if ball_milling_uids is not None:
+        ball_milling_table = filtered_table(sql_ball_milling_table_name, hot_press_uid_column, ball_milling_uids)
+        materials_table = filtered_table(sql_materials_table_name, materials_ball_milling_column, ball_milling_uids)
+    if hot_press_uids is not None:
+        hot_press_table = filtered_table(sql_hot_press_table_name, hot_press_uid_column, hot_press_uids)
+
+    if material_aggregates:
+        materials_join = psycopg2_sql.SQL("""LEFT JOIN (SELECT {merge_column}, {aggregates} FROM {materials_table} GROUP BY {merge_column}) AS materials
+                                          ON materials.{merge_column} = bm.{uid_column}""").format(
+            merge_column=psycopg2_sql.Identifier(materials_ball_milling_column),
+            aggregates=psycopg2_sql.SQL(', ').join(material_aggregates),
+            materials_table=materials_table,
+            uid_column=psycopg2_sql.Identifier(hot_press_uid_column))
+    else:
+        materials_join = psycopg2_sql.SQL('')
+
+    sort_key = psycopg2_sql.SQL("COALESCE(bm.{hot_press_column}, hp.{uid_column})").format(
+        hot_press_column=psycopg2_sql.Identifier(ball_milling_hot_press_column),
+        uid_column=psycopg2_sql.Identifier(hot_press_uid_column))
+    selected = [expression for name, expression in select_columns]
+    if row_keys:
+        selected += [psycopg2_sql.Identifier('bm', hot_press_uid_column), psycopg2_sql.Identifier('hp', hot_press_uid_column), sort_key]
+
+    query = psycopg2_sql.SQL("""SELECT {select_columns}
+                             FROM {ball_milling_table} AS bm
+                             FULL OUTER JOIN {hot_press_table} AS hp ON bm.{hot_press_column} = hp.{uid_column}
+                             {materials_join}
+                             {lab_joins}
+                             ORDER BY {sort_key} COLLATE "C", bm.{uid_column} COLLATE "C";""").format(
+        select_columns=psycopg2_sql.SQL(', ').join(selected),
+        ball_milling_table=ball_milling_table,
+        hot_press_table=hot_press_table,
+        sort_key=sort_key,
+        hot_press_column=psycopg2_sql.Identifier(ball_milling_hot_press_column),
+        uid_column=psycopg2_sql.Identifier(hot_press_uid_column),
+        materials_join=materials_join,
+        lab_joins=psycopg2_sql.SQL(' ').join(lab_joins))
+
+    return query, [name for name, expression in select_columns]
+
+def filtered_table(table_name, column_name, match_values):
+    """
+    Returns a subquery selecting the rows of table_name where column_name has one of match_values, for use in place of the table in build_master_query.
+    """
+    return psycopg2_sql.SQL("(SELECT * FROM {table} WHERE {column} = ANY({match_values}))").format(
+        table=psycopg2_sql.Identifier(table_name),
+        column=psycopg2_sql.Identifier(column_name),
+        match_values=psycopg2_sql.Literal(list(match_values)))
+
+def write_master_csv(sql_df, output_path, partition_by=None):
+    """
+    Writes the master DataFrame to a csv file at output_path. csv output cannot be partitioned.
+    """
+    sql_df.to_csv(output_path)
+
+def master_arrow_table(sql_df):
+    """
+    Converts the master DataFrame to a pyarrow Table for the columnar output formats. The row numbers written as the first column of the csv are not kept and string columns are dictionary encoded, so each distinct value (e.g., a process or gas name) is stored once per column chunk.
+
+    pyarrow is only needed for the columnar output formats and is imported here.
+    """
+    import pyarrow
+
+    table = pyarrow.Table.from_pandas(sql_df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pyarrow.types.is_string(field.type) or pyarrow.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    return table
+
+def write_master_parquet(sql_df, output_path, partition_by=None):
+    """
+    Writes the master DataFrame to a Parquet file at output_path or, with partition_by, to a directory at output_path with a subdirectory for each value of the partition_by columns (e.g., hot_press_process_name=Hot Isostatic Press/).
+
+    Selected columns can be loaded with pyarrow.parquet.read_table(output_path, columns=[...], memory_map=True).
+    """
+    import pyarrow.parquet
+
+    table = master_arrow_table(sql_df)
+    if partition_by:
+        pyarrow.parquet.write_to_dataset(table, output_path, partition_cols=list(partition_by))
+    else:
+        pyarrow.parquet.write_table(table, output_path)
+
+def write_master_arrow(sql_df, output_path, partition_by=None):
+    """
+    Writes the master DataFrame to an Arrow IPC file at output_path or, with partition_by, to a directory of Arrow IPC files partitioned the same way as write_master_parquet.
+
+    The file can be memory mapped and selected columns read without copying or parsing them: pyarrow.ipc.open_file(pyarrow.memory_map(output_path)).read_all().select([...]).
+    """
+    import pyarrow
+    import pyarrow.dataset
+
+    table = master_arrow_table(sql_df)
+    if partition_by:
+        pyarrow.dataset.write_dataset(table, output_path, format='ipc', partitioning=list(partition_by), partitioning_flavor='hive')
+    else:
+        with pyarrow.OSFile(output_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+# Writers for each output format of create_master_csv
+# {output_format : {'extension' : file extension, 'writer' : function(sql_df, output_path, partition_by)}}
+output_writers = {'csv' : {'extension' : 'csv', 'writer' : write_master_csv},
+                  'parquet' : {'extension' : 'parquet', 'writer' : write_master_parquet},
+                  'arrow' : {'extension' : 'arrow', 'writer' : write_master_arrow}}
@@ -0,0 +1,83 @@
+import json
+import os
+
+import measurement_registry
+
+"""
+The ingestion manifest is a local json file recording every lab file that has been added to the database, so that later runs can skip files that have not changed without opening them.
+
+Each file is recorded by its absolute path with its size, modification time (in nanoseconds) and a sha256 hash of its contents:
+{path : {'size' : size, 'mtime_ns' : mtime_ns, 'sha256' : sha256}}
+
+A file whose size and modification time match the manifest is skipped before it is opened. If either has changed, the file is read and hashed; files with the same contents are skipped (only the manifest is updated) while files with different contents are reported as edited. Edited files are not re-added as the database is never updated with changes to existing records (see lab_to_db_updater.add_new_lab_results).
+
+Only files of a known type of measurement (see measurement_registry) are recorded. Files of other types are not added to the database, so they are read again on later runs and are added once their type of measurement is described.
+"""
+
+class Ingestion_Manifest():
+    def __init__(self, manifest_path):
+        """
+        'manifest_path' is the json file to read from and save to; it is created on the first save if it does not exist.
+        """
+        self.manifest_path = manifest_path
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as file:
+                self.entries = json.load(file)
+        else:
+            self.entries = {}
+
+        # entries waiting to be saved once their records are committed to the database
+        self.pending_entries = {}
+        # files found to have different contents than when they were added
+        self.edited_files = []
+
+    def is_unchanged(self, file_path):
+        """
+        Returns True if file_path is in the manifest with the same size and modification time. Only stats the file; it is not opened.
+        """
+        entry = self.entries.get(os.path.abspath(file_path))
+        if entry is None:
+            return False
+        stat = os.stat(file_path)
+        return entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def check_read_files(self, read_files):
+        """
+        Takes a list of (file_path, lab_file, size, mtime_ns, sha256) tuples (see lab_file_handler.read_lab_file) and returns the list of lab_file dictionaries that are new.
+
+        New files and files with unchanged contents are staged to be recorded in the manifest on the next save, unless their measurement is not a known type. Files with changed contents are added to edited_files.
+        """
+        new_files = []
+        for file_path, lab_file, size, mtime_ns, sha256 in read_files:
+            key = os.path.abspath(file_path)
+            entry = self.entries.get(key)
+            if entry is None:
+                new_files.append(lab_file)
+                if measurement_registry.get_measurement_type(lab_file.get('Measurement')) is None:
+                    # not added to the database; read it again next time in case its type is added
+                    continue
+            elif entry['sha256'] != sha256:
+                self.edited_files.append(file_path)
+                continue
+            self.pending_entries[key] = {'size' : size, 'mtime_ns' : mtime_ns, 'sha256' : sha256}
+        return new_files
+
+    def discard_pending(self):
+        """
+        Forgets the staged entries, e.g., when the transaction adding their records is rolled back.
+        """
+        self.pending_entries = {}
+
+    def save(self):
+        """
+        Records the staged entries and writes the manifest. This should only be called once the records from those files have been committed to the database.
+        """
+        self.entries.update(self.pending_entries)
+        self.pending_entries = {}
+
+        # write to a temporary file first so an interrupted save does not corrupt the manifest
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, "w") as file:
+            json.dump(self.entries, file)
+        os.replace(temp_path, self.manifest_path)
@@ -1,9 +1,82 @@
+import glob
+import hashlib
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import run_metrics
+
+def parse_lab_lines(lines):
+    """
+    Creates a dictionary of fields from the lines of a lab file.
+
+    If the file format of lab files changes, this function will need to be modified respectively.
+    """
+    lab_file = {}
+    for n, line in enumerate(lines):
+        # skip over first two lines (no information in lab file format)
+        if n > 1:
+            # split on tabs
+            line = line.split('\t')
+            # add key and item pair to dictionary
+            lab_file[line[0].strip()] = line[-1].strip()
+    return lab_file
+
+def parse_lab_file(file_path):
+    """
+    Reads a single lab file and returns a dictionary of its fields.
+    """
+    with open(file_path, "r") as file:
+        return parse_lab_lines(file)
+
+def read_lab_file(file_path):
+    """
+    Reads a single lab file and returns a tuple of (file_path, dictionary of its fields, size, mtime_ns, sha256 of its contents) for use with an Ingestion_Manifest. The file is only read once.
+    """
+    with open(file_path, "rb") as file:
+        stat = os.fstat(file.fileno())
+        contents = file.read()
+    lab_file = parse_lab_lines(io.TextIOWrapper(io.BytesIO(contents)))
+    return file_path, lab_file, stat.st_size, stat.st_mtime_ns, hashlib.sha256(contents).hexdigest()
+
+def expand_lab_directories(patterns):
+    """
+    Returns the list of lab directories for a list of directories and glob patterns (e.g., 'drops/*/'), in order and without repeats. Raises a ValueError if a pattern matches no directories.
+    """
+    directories = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [pattern]
+        else:
+            matches = [path for path in sorted(glob.glob(pattern)) if os.path.isdir(path)]
+        if not matches:
+            raise ValueError(f"No lab directories match {pattern}")
+        for directory in matches:
+            if os.path.abspath(directory) not in [os.path.abspath(existing) for existing in directories]:
+                directories.append(directory)
+    return directories
 
 class Lab_File_Handler():
-    def __init__(self, lab_files_directory):
+    def __init__(self, lab_files_directory, workers=None, pool_type='process', manifest=None, lab_filenames=None):
+        """
+        'workers' is the number of worker processes (or threads) used to parse files; None or 1 parses files in this process.
+        'pool_type' is either 'process' or 'thread'. Parsing is mostly Python so processes usually scale better, but threads avoid the start up cost for small directories.
+        'manifest' is an optional ingestion_manifest.Ingestion_Manifest; files it has already recorded are skipped if they have not changed.
+        'lab_filenames' is an optional list of the files in lab_files_directory to use (e.g., files reported by a lab_watcher.Lab_Directory_Watcher) so that the directory is not listed.
+        """
         self.lab_files_directory = lab_files_directory
-        self.lab_filenames = [file for file in os.listdir(self.lab_files_directory) if file[-4:] == '.txt']
+        if lab_filenames is None:
+            with run_metrics.stage('list_lab_files'):
+                self.lab_filenames = [file for file in os.listdir(self.lab_files_directory) if file[-4:] == '.txt']
+        else:
+            self.lab_filenames = list(lab_filenames)
+        run_metrics.count('lab_files_listed', len(self.lab_filenames))
+
+        if pool_type not in ('process', 'thread'):
+            raise ValueError(f"pool_type must be 'process' or 'thread', not {pool_type}")
+        self.workers = workers
+        self.pool_type = pool_type
+        self.manifest = manifest
 
         self.files = None
 
@@ -11,22 +84,60 @@ class Lab_File_Handler():
         """
         Function loops through all files in lab_files_directory and creates a dictionary object from each.
 
-        If the file format of lab files changes, this function will need to be modified respectively.
+        All dictionaries are kept in self.files; for large directories iter_lab_files should be used instead.
 
         Note: this loops through ALL .txt files in the given directory; it expects no other .txt files to be in the directory BUT lab files.
         """
         files = []
-        # Loop through filenames collected from lab_files_directory
-        for filename in self.lab_filenames:
-            temp_dict = {}
-            with open(self.lab_files_directory + filename, "r") as file:
-                for n, line in enumerate(file):
-                    # skip over first two lines (no information in lab file format)
-                    if n > 1:
-                        # split on tabs
-                        line = line.split('\t')
-                        # add key and item pair to dictionary
-                        temp_dict[line[0].strip()] = line[-1].strip()
-            # collect dictionary item
-            files.append(temp_dict)
+        for chunk in self.iter_lab_files():
+            # collect dictionary items
+            files.extend(chunk)
         self.files = files
+
+    def iter_lab_files(self, chunk_size=1000):
+        """
+        Generator that parses the files in lab_files_directory and yields them as lists of at most chunk_size dictionaries.
+
+        Only the chunk being yielded and (when using workers) the chunk being parsed are held in memory, so memory use does not depend on the size of the directory.
+
+        With a manifest, unchanged files are skipped without being opened and only new files are yielded (see Ingestion_Manifest.check_read_files), so chunks may be smaller than chunk_size.
+        """
+        file_paths = [os.path.join(self.lab_files_directory, filename) for filename in self.lab_filenames]
+        if self.manifest is None:
+            parse_function = parse_lab_file
+        else:
+            with run_metrics.stage('check_manifest'):
+                file_paths = [path for path in file_paths if not self.manifest.is_unchanged(path)]
+            run_metrics.count('lab_files_skipped', len(self.lab_filenames) - len(file_paths))
+            parse_function = read_lab_file
+        path_chunks = [file_paths[i:i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+
+        for parsed_chunk in run_metrics.timed_iter(self._parse_chunks(path_chunks, parse_function, chunk_size), 'parse_lab_files'):
+            run_metrics.count('lab_files_parsed', len(parsed_chunk))
+            if self.manifest is None:
+                yield parsed_chunk
+            else:
+                new_files = self.manifest.check_read_files(parsed_chunk)
+                if new_files:
+                    yield new_files
+
+    def _parse_chunks(self, path_chunks, parse_function, chunk_size):
+        """
+        Generator that applies parse_function to each chunk of paths, using a worker pool if workers is set.
+        """
+        if not self.workers or self.workers == 1:
+            for path_chunk in path_chunks:
+                yield [parse_function(path) for path in path_chunk]
+        else:
+            pool_class = ProcessPoolExecutor if self.pool_type == 'process' else ThreadPoolExecutor
+            with pool_class(max_workers=self.workers) as pool:
+                # spread each chunk over the workers; the next chunk is parsed while the current one is being used
+                map_chunksize = max(1, chunk_size // (self.workers * 4))
+                pending = None
+                for path_chunk in path_chunks:
+                    submitted = pool.map(parse_function, path_chunk, chunksize=map_chunksize)
+                    if pending is not None:
+                        yield list(pending)
+                    pending = submitted
+                if pending is not None:
+                    yield list(pending)
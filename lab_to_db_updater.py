@@ -1,162 +1,554 @@
+import asyncio
+import multiprocessing
+import queue
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql as psycopg2_sql
+
 import postgres_handler
 import lab_file_handler
+import ingestion_manifest
+import run_metrics
+import measurement_registry
 """
 This file uses the lab_file_handler and converts that data so that it can be uploaded into the SQL database.
 
-The definition add_new_lab_results relies on the hardcoded values in "measurment_types" as well as the name of the "unique_id_column_name" used in the lab results file. There appear to be a one to one relationship between measurements and materials so 'material_id' acts as the unique ID; each material is only measured once.
+The definition add_new_lab_results relies on the measurement types described in the measurements directory (see measurement_registry) as well as the name of the "unique_id_column_name" used in the lab results file. There appear to be a one to one relationship between measurements and materials so 'material_id' acts as the unique ID; each material is only measured once.
 
 The definition create_lab_tables, however, requires some thought in renaming whatever fields are in the lab result files into proper SQL columns and data types. This is the most manual part of the program and would need to be changed if the lab result file changes.
 """
 
-"""
-Measurements:
-identifier = the text string found on the lab result file denoting the type of measurment (e.g., 'ICP', 'Hall')
-sql_table_name = the name you wish the sql table to be called upon creation
-sql_column_string = a sql string used to create the sql table consisting of column names and data types
-
-measurement_types should be in the format:
-{'identifier' : identifier,
-'sql_table_name' : sql_table_name,
-'sql_unique_id_column_name' : 'material_uid'
-'sql_column_string' : sql_column_string}
-
-NOTE: the sql_unique_id_column_name should be identical to the name used in the sql_column_string!
-"""
-
-measurement_types = [{
-                      'identifier' : 'ICP',
-                      'sql_table_name' : 'icp_lab',
-                      'sql_unique_id_column_name' : 'material_uid',
-                      'sql_column_string' : """
-                      material_uid character varying(30) NOT NULL,
-                      measurement character varying(10),
-                      pb_concentration real,
-                      sn_concentration real,
-                      o_concentration real,
-                      gas_flow_rate_l_min real,
-                      gas_type character varying(10),
-                      plasma_temperature_celsius real,
-                      detector_temperature_celsius real,
-                      field_strength_t real,
-                      plasma_observation character varying(40),
-                      radio_requency_mhz real
-                      """
-                      },
-                      {
-                       'identifier' : 'Hall',
-                       'sql_table_name' : 'hall_lab',
-                       'sql_unique_id_column_name' : 'material_uid',
-                       'sql_column_string' : """
-                       material_uid character varying(30) NOT NULL,
-                       measurement character varying(10),
-                       probe_resistance_ohm real,
-                       gas_flow_rate_l_min real,
-                       gas_type character varying(10),
-                       probe_material character varying(30),
-                       current_mA real,
-                       field_strength_t real,
-                       sample_position real,
-                       magnet_reversal bool
-                       """
-                       }]
-
 # This is the column name from the LAB FILE specifically used to identify if a record exists in the database or not
 unique_id_column_name = 'material_uid'
 
+# Process table columns that lab results and materials are looked up by when the master csv is made (see csv_creater); create_lab_tables adds an index to any of them without one
+# [(sql_table_name, sql_column_name)]
+supporting_indexes = [('ball_milling', 'hot_press_uid'),
+                      ('ball_milling', 'output_material_uid'),
+                      ('hot_press', 'output_material_uid'),
+                      ('material_procurement', 'ball_milling_uid')]
+
+def parse_bool(value):
+    """
+    Converts the text of a boolean lab file field (e.g., 'True', 'false', '1') to a bool, accepting the same values as postgres.
+    """
+    value = value.strip().lower()
+    if value in ('true', 't', 'yes', 'y', 'on', '1'):
+        return True
+    if value in ('false', 'f', 'no', 'n', 'off', '0'):
+        return False
+    raise ValueError(f"{value} is not a boolean value")
+
+# Functions converting lab file text to Python values by sql data type (as named in information_schema); values of other types are sent as text
+sql_type_converters = {'real' : float,
+                       'double precision' : float,
+                       'smallint' : int,
+                       'integer' : int,
+                       'bigint' : int,
+                       'boolean' : parse_bool}
+
+def field_column_name(field_name):
+    """
+    Returns the sql column name for a lab file field name: lower case with runs of other characters replaced by underscores (e.g., 'Gas Flow Rate (L/min)' is gas_flow_rate_l_min).
+    """
+    return re.sub(r'[^0-9a-z]+', '_', field_name.lower()).strip('_')
+
+def create_measurements():
+    """
+    Returns a Measurement for each of the measurement types (see measurement_registry).
+    """
+    return [Measurement(measurement_type['identifier'], measurement_type['sql_table_name'], measurement_type['field_renames'])
+            for measurement_type in measurement_registry.measurement_types()]
+
 class Measurement():
-    def __init__(self, identifier, sql_table_name):
+    def __init__(self, identifier, sql_table_name, field_renames=None):
         """
         'id' is the identifier used in the lab result files to denote what type of measurement is used. It is case sensetive.
         'table_name' is the name used to create the SQL table for that type of measurment (per create_lab_tables).
+        'field_renames' is an optional dictionary {lab file field name : sql column name} for fields whose column name is not field_column_name(field name).
         """
         self.id = identifier
         self.table_name = sql_table_name
+        self.field_renames = field_renames or {}
 
         self.record_column_decode_dict = {}
         self.sql_columns = None
+        # {sql column name : function converting lab file text to the column's type}
+        self.column_converters = None
 
     def collect_sql_column_names(self, postgres_handler_sql_object):
         """
-        Collect the column names in the SQL database (per create_lab_tables).
+        Collect the column names and data types in the SQL database (per create_lab_tables) and the functions used to convert values to each column's type (see sql_type_converters). This is only done once.
         """
-        self.sql_columns = postgres_handler_sql_object.collect_table_column_names(self.table_name)
+        if self.sql_columns is not None:
+            return
+        column_types = postgres_handler_sql_object.collect_table_column_types(self.table_name)
+        self.sql_columns = [name for name, data_type in column_types]
+        self.column_converters = {name : sql_type_converters[data_type] for name, data_type in column_types if data_type in sql_type_converters}
 
     def create_record_column_decode_dict(self, example_file, postgres_handler_sql_object):
         """
         Create a dictionary that can cross reference the field names in the lab result files with the SQL column names.
+
+        Fields are matched to columns by name (see field_column_name and field_renames), so the order of the fields in the files does not matter. Fields not already in the dictionary are added; a field without a matching column raises a ValueError.
         """
-        if self.record_column_decode_dict:
-            pass
-        else:
-            raw_column_names = list(example_file.keys())
-            if self.sql_columns:
-                pass
-            else:
-                self.collect_sql_column_names(postgres_handler_sql_object)
-            for name in self.sql_columns:
-                self.record_column_decode_dict[raw_column_names.pop(0)] = name
+        self.collect_sql_column_names(postgres_handler_sql_object)
+        for field in example_file.keys():
+            if field in self.record_column_decode_dict:
+                continue
+            column = self.field_renames.get(field, field_column_name(field))
+            if column not in self.sql_columns:
+                raise ValueError(f"Field {field} of {self.id} lab files has no column in table {self.table_name}")
+            self.record_column_decode_dict[field] = column
 
-def add_new_lab_results(connect_statement, lab_files_directory):
+    def convert_records(self, files):
+        """
+        Returns the list of sql column names and the list of rows (tuples of values in the same order) for a list of lab file dictionaries, ready for SQL_Connector.add_rows. The columns are those of every field in any of the files, which must all be in the record_column_decode_dict (see create_record_column_decode_dict); files without a field have None in its column.
+
+        Values are converted a column at a time to the Python type of their column (see sql_type_converters), so numbers and booleans are sent as such rather than as text for the database to cast. Empty values are None.
+        """
+        # every field in the files, in the order they are first seen
+        fields = list(dict.fromkeys(field for file in files for field in file))
+        columns = [self.record_column_decode_dict[field] for field in fields]
+        converted_columns = []
+        for field, column in zip(fields, columns):
+            values = [file.get(field) for file in files]
+            converter = self.column_converters.get(column)
+            if converter is not None:
+                values = [None if value is None or value == '' else converter(value) for value in values]
+            converted_columns.append(values)
+        return columns, list(zip(*converted_columns))
+
+def add_new_lab_results(connect_statement, lab_files_directory, bulk=True, chunk_size=1000, workers=None, pool_type='process', manifest_path=None, lab_filenames=None, engine='sync', queue_size=2):
     """
     Adds all records for all new files to database from the lab_files_directory. Checks to see if record already exists based on unique_id_column_name (e.g., 'material_uid').
 
+    Files are parsed and added chunk_size files at a time (see Lab_File_Handler.iter_lab_files) so memory use does not grow with the size of the directory. 'workers' and 'pool_type' are passed to the Lab_File_Handler to parse files in parallel.
+
+    connect_statement may also be an SQL_Connector, in which case the records are committed whenever its owner commits (see postgres_handler.use_connection).
+
+    If manifest_path is given, an ingestion manifest (see ingestion_manifest.py) is used to skip files that were added on earlier runs and have not changed; the manifest is updated once the new records are committed. Files edited since they were added are reported but not updated in the database. manifest_path may also be an Ingestion_Manifest that has already been loaded (e.g., one kept between calls).
+
+    lab_filenames is an optional list of the files in lab_files_directory to add; by default every .txt file in the directory is used.
+
+    By default records are grouped by measurement and checked/inserted in bulk (see add_lab_records). Setting bulk to False uses the original one record at a time approach (see add_lab_records_row_at_a_time); both add the same records.
+
+    engine is either 'sync', which parses and adds each chunk of files in turn, or 'async', which parses the next chunks while earlier ones are being added to the database (see add_lab_records_async). queue_size is the number of parsed chunks of each measurement the 'async' engine holds while they wait to be added. Both add the same records; 'async' always adds them in bulk.
+
     Note: this creates a dictionary (record_column_decode_dict) to map the keys from the actual files to the column names that were created in the create_lab_tables function. If the lab files are updated or change and sql table has not been modified to accomidate, this will fail. If there are multiple types of lab files, they will have to be handled seperately just as ICP and Hall are currently handled seperately.
     """
-    # Use lab_handler to collect lab files as dictionaries
-    lab_handler = lab_file_handler.Lab_File_Handler(lab_files_directory)
-    lab_handler.collect_lab_files()
+    # Load the manifest of files already added
+    if isinstance(manifest_path, ingestion_manifest.Ingestion_Manifest):
+        manifest = manifest_path
+        manifest.edited_files = []
+    elif manifest_path:
+        manifest = ingestion_manifest.Ingestion_Manifest(manifest_path)
+    else:
+        manifest = None
 
-    # connect to sql database
-    sql = postgres_handler.SQL_Connector(connect_statement)
+    if engine not in ('sync', 'async'):
+        raise ValueError(f"engine must be 'sync' or 'async', not {engine}")
+
+    # Use lab_handler to stream lab files as dictionaries
+    lab_handler = lab_file_handler.Lab_File_Handler(lab_files_directory, workers=workers, pool_type=pool_type, manifest=manifest,
+                                                    lab_filenames=lab_filenames)
 
     # Loop through hardcoded measurements to create handler objects
-    measurements = [Measurement(measurement_type['identifier'], measurement_type['sql_table_name']) for measurement_type in measurement_types]
+    measurements = create_measurements()
+
+    # connect to sql database (or use the connection already given)
+    with postgres_handler.use_connection(connect_statement) as sql:
+        # count records added to database
+        count = 0
+        if engine == 'async':
+            count = asyncio.run(add_lab_records_async(sql, measurements, lab_handler.iter_lab_files(chunk_size), queue_size))
+        else:
+            for files in lab_handler.iter_lab_files(chunk_size):
+                if bulk:
+                    count += add_lab_records(sql, measurements, files)
+                else:
+                    count += add_lab_records_row_at_a_time(sql, measurements, files)
+
+        if manifest:
+            # Only record files in the manifest once their records are committed
+            sql.on_commit.append(manifest.save)
+
+    run_metrics.count('records_added', count)
+    print(count, 'records added to database.')
+
+    if manifest:
+        if manifest.edited_files:
+            print(len(manifest.edited_files), 'lab files were edited after being added to the database and were not updated:')
+            for file_path in manifest.edited_files:
+                print(file_path)
+
+# Seconds add_new_lab_results_sharded waits on a worker's queue before checking that the worker is still alive
+worker_poll_interval = 1
+
+def add_new_lab_results_sharded(connect_statement, lab_files_directories, shards, chunk_size=1000, workers=None, pool_type='process', manifest_path=None, queue_size=4):
+    """
+    Adds all records for all new files in every directory of lab_files_directories using 'shards' worker processes, each with its own connection, and returns the number of records added and the list of errors.
+
+    Files are parsed here (in parallel if workers is set; see Lab_File_Handler) and each record is sent to the worker chosen by a hash of its unique_id_column_name (see shard_for_record), so the same record always goes to the same worker and workers never add the same record at the same time. Workers add the records they are sent chunk by chunk, committing each chunk in its own transaction (see _shard_worker). queue_size is the number of chunks waiting for each worker before parsing waits for the workers to catch up.
+
+    Unlike add_new_lab_results, the records are not added in the caller's transaction: connect_statement must be a SQL connection argument. A chunk that fails is rolled back and its error is returned; the other chunks are still committed. Workers report each chunk as they finish it, so a worker that dies (e.g., killed for running out of memory) is reported as an error with the number of files sent to it that it had not finished, which may not have been added; the records it had committed are still counted. Files for a dead worker are left out rather than waited on. With manifest_path, the manifest (shared by every directory) is only saved if there were no errors.
+    """
+    if manifest_path:
+        manifest = ingestion_manifest.Ingestion_Manifest(manifest_path)
+    else:
+        manifest = None
+
+    shard_queues = [multiprocessing.Queue(maxsize=queue_size) for shard in range(shards)]
+    result_queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_shard_worker, args=(shard, connect_statement, shard_queues[shard], result_queue, measurement_registry.registry.directory))
+                 for shard in range(shards)]
+    for process in processes:
+        process.start()
+
+    # {shard : number of files not sent because its worker had died}
+    dead_shards = {}
+    # number of files sent to and finished by each worker (added or failed)
+    files_sent = [0] * shards
+    files_finished = [0] * shards
+
+    def send(shard, item):
+        # waits for room on the worker's queue, giving up if the worker has died
+        if shard in dead_shards:
+            return False
+        while True:
+            try:
+                shard_queues[shard].put(item, timeout=worker_poll_interval)
+                return True
+            except queue.Full:
+                if not processes[shard].is_alive():
+                    dead_shards[shard] = 0
+                    return False
 
-    # count records added to database
     count = 0
+    errors = []
+    try:
+        measurement_ids = set(measurement_registry.registry.identifiers())
+        for lab_files_directory in lab_files_directories:
+            lab_handler = lab_file_handler.Lab_File_Handler(lab_files_directory, workers=workers, pool_type=pool_type, manifest=manifest)
+            for files in lab_handler.iter_lab_files(chunk_size):
+                shard_files = [[] for shard in range(shards)]
+                for file in files:
+                    if file.get('Measurement') in measurement_ids:
+                        shard_files[shard_for_record(file, shards)].append(file)
+                for shard, files_for_shard in enumerate(shard_files):
+                    if not files_for_shard:
+                        continue
+                    if send(shard, files_for_shard):
+                        files_sent[shard] += len(files_for_shard)
+                    else:
+                        dead_shards[shard] += len(files_for_shard)
+    finally:
+        # tell the workers there are no more files
+        for shard in range(shards):
+            send(shard, None)
+        # read every worker's results until it is done before joining them, as a worker cannot exit until its results have been read
+        done_shards = set()
+        while len(done_shards) < shards:
+            try:
+                shard, finished, added, error = result_queue.get(timeout=worker_poll_interval)
+            except queue.Empty:
+                if not any(process.is_alive() for shard, process in enumerate(processes) if shard not in done_shards) and result_queue.empty():
+                    # the remaining workers died before they were done
+                    break
+                continue
+            if finished is None:
+                done_shards.add(shard)
+                continue
+            files_finished[shard] += finished
+            count += added
+            if error:
+                errors.append(error)
+        for process in processes:
+            process.join()
 
-    # loop through files
-    for file in lab_handler.files:
-        # Loop through measurements
-        for measurement in measurements:
-            # Check if correct measurement
-            if measurement.id == file['Measurement']:
-                # Create the record_column_decode_dict
-                measurement.create_record_column_decode_dict(file, sql)
-                # Check if record already exists
-                if sql.check_record_exists(measurement.table_name,
-                                        measurement.record_column_decode_dict[unique_id_column_name],
-                                        file[unique_id_column_name]):
-                    # record exists; do not update
-                    pass
-                else:
-                    # Add new record
-                    sql.add_record(measurement.table_name, file, measurement.record_column_decode_dict)
-                    count += 1
+    for shard, process in enumerate(processes):
+        if process.exitcode != 0:
+            errors.append(f"Worker {shard} exited with code {process.exitcode}")
+        if files_sent[shard] > files_finished[shard]:
+            errors.append(f"{files_sent[shard] - files_finished[shard]} files sent to worker {shard} may not have been added")
+        if dead_shards.get(shard):
+            errors.append(f"{dead_shards[shard]} files for worker {shard} were not added")
+
+    run_metrics.count('records_added', count)
+    print(count, 'records added to database by', shards, 'workers.')
+    if errors:
+        print(len(errors), 'errors while adding lab files:')
+        for error in errors:
+            print(error)
+
+    if manifest:
+        if not errors:
+            manifest.save()
+        if manifest.edited_files:
+            print(len(manifest.edited_files), 'lab files were edited after being added to the database and were not updated:')
+            for file_path in manifest.edited_files:
+                print(file_path)
+    return count, errors
+
+def shard_for_record(file, shards):
+    """
+    Returns the worker (0 to shards - 1) a lab file dictionary is sent to by add_new_lab_results_sharded, from a hash of its unique_id_column_name that is the same in every process and run.
+    """
+    return zlib.crc32(str(file.get(unique_id_column_name, '')).encode('utf-8')) % shards
+
+def _shard_worker(shard, connect_statement, shard_queue, result_queue, measurement_directory):
+    """
+    Worker process for add_new_lab_results_sharded. Adds the lists of lab file dictionaries from shard_queue until it gets None, committing after each list. measurement_directory is the directory of the coordinator's measurement types (see measurement_registry.use_directory).
+
+    After each list it puts (shard, number of files finished, number of records added, error or None) on result_queue, and (shard, None, 0, None) once it is done.
+    """
+    sql = None
+    try:
+        measurement_registry.use_directory(measurement_directory)
+        sql = postgres_handler.SQL_Connector(connect_statement)
+        measurements = create_measurements()
+        while True:
+            files = shard_queue.get()
+            if files is None:
                 break
-            else:
-                # Not correct measurement
-                pass
+            try:
+                chunk_count = add_lab_records(sql, measurements, files)
+                sql.commit()
+                result_queue.put((shard, len(files), chunk_count, None))
+            except Exception as e:
+                result_queue.put((shard, len(files), 0, f"{len(files)} files starting with {files[0].get(unique_id_column_name)}: {e}"))
+                try:
+                    sql.rollback()
+                except Exception:
+                    # the connection was lost
+                    sql.reconnect()
+    except Exception as e:
+        # keep taking chunks so the coordinator is not left waiting on a full queue
+        skipped = 0
+        files = shard_queue.get()
+        while files is not None:
+            skipped += len(files)
+            files = shard_queue.get()
+        result_queue.put((shard, skipped, 0, f"Worker {shard} stopped: {e}"))
+    finally:
+        if sql is not None:
+            sql.disconnect()
+        result_queue.put((shard, None, 0, None))
 
-    sql.commit()
-    sql.disconnect()
+def add_lab_records(sql, measurements, files):
+    """
+    Adds the new records from a list of lab file dictionaries and returns the number of records added.
 
-    print(count, 'records added to database.')
+    Files are grouped by measurement so that each measurement table needs one query to find the records that already exist and a few multi-row inserts for the new ones, rather than two round trips to the database per file. Files repeating a unique_id_column_name value are only added once.
+    """
+    files_by_measurement = group_files_by_measurement(measurements, files)
+
+    count = 0
+    for measurement in measurements:
+        measurement_files = files_by_measurement[measurement.id]
+        if measurement_files:
+            count += add_measurement_records(sql, measurement, measurement_files)
+    return count
+
+def group_files_by_measurement(measurements, files):
+    """
+    Returns dictionary {measurement id : list of lab file dictionaries} for a list of lab file dictionaries. Files that are not one of the measurements are left out.
+    """
+    files_by_measurement = {measurement.id : [] for measurement in measurements}
+    for file in files:
+        if file['Measurement'] in files_by_measurement:
+            files_by_measurement[file['Measurement']].append(file)
+        else:
+            # Not a known measurement
+            pass
+    return files_by_measurement
 
-def create_lab_tables(connect_statement):
+def add_measurement_records(sql, measurement, measurement_files):
     """
-    Creates tables hall_lab and icp_lab tables in sql database located at connect_statement. This does check to see if table already exists and, if so, does nothing.
+    Adds the new records from a list of lab file dictionaries of one measurement and returns the number of records added (see add_lab_records).
+    """
+    # Create the record_column_decode_dict from every file, so a field missing from the first file is still added and an unknown field in any file raises a ValueError
+    for file in measurement_files:
+        measurement.create_record_column_decode_dict(file, sql)
+    # Collect records that already exist in one query
+    with run_metrics.stage('check_existing_records'):
+        existing_ids = sql.collect_existing_values(measurement.table_name,
+                                                   measurement.record_column_decode_dict[unique_id_column_name],
+                                                   [file[unique_id_column_name] for file in measurement_files])
+    run_metrics.count('records_existing', len(existing_ids))
+    new_records = []
+    for file in measurement_files:
+        if file[unique_id_column_name] in existing_ids:
+            # record exists; do not update
+            pass
+        else:
+            existing_ids.add(file[unique_id_column_name])
+            new_records.append(file)
+    # Add new records as typed rows
+    if new_records:
+        with run_metrics.stage('convert_records'):
+            columns, rows = measurement.convert_records(new_records)
+        with run_metrics.stage('insert_records'):
+            sql.add_rows(measurement.table_name, columns, rows)
+    return len(new_records)
+
+async def add_lab_records_async(sql, measurements, file_chunks, queue_size=2):
+    """
+    Adds the new records from an iterator of lists of lab file dictionaries (e.g., Lab_File_Handler.iter_lab_files) and returns the number of records added.
+
+    A producer takes chunks from file_chunks (parsing them) in a worker thread and puts each measurement's files on that measurement's queue, and a consumer for each measurement adds them (see add_measurement_records) in another worker thread. Parsing the next chunks overlaps with waiting on the database. The queues hold at most queue_size chunks, so the producer waits when the database falls behind and memory use stays flat.
+
+    The consumers take turns on the one connection (psycopg2 connections cannot run queries at the same time), so every record is still added in the same transaction.
+    """
+    loop = asyncio.get_running_loop()
+    parse_executor = ThreadPoolExecutor(max_workers=1)
+    database_executor = ThreadPoolExecutor(max_workers=1)
+    queues = {measurement.id : asyncio.Queue(maxsize=queue_size) for measurement in measurements}
+
+    async def produce():
+        while True:
+            files = await loop.run_in_executor(parse_executor, next, file_chunks, None)
+            if files is None:
+                break
+            files_by_measurement = group_files_by_measurement(measurements, files)
+            for measurement in measurements:
+                if files_by_measurement[measurement.id]:
+                    await queues[measurement.id].put(files_by_measurement[measurement.id])
+        # tell the consumers there are no more files
+        for measurement_queue in queues.values():
+            await measurement_queue.put(None)
+
+    async def consume(measurement):
+        count = 0
+        while True:
+            measurement_files = await queues[measurement.id].get()
+            if measurement_files is None:
+                return count
+            count += await loop.run_in_executor(database_executor, add_measurement_records, sql, measurement, measurement_files)
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(consume(measurement)) for measurement in measurements]
+    try:
+        counts = await asyncio.gather(*tasks)
+    except BaseException:
+        # stop the other tasks so none are left waiting on a queue
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        # wait for any parsing or query already started in the worker threads to finish
+        parse_executor.shutdown(wait=True)
+        database_executor.shutdown(wait=True)
+    return sum(counts[1:])
+
+def add_lab_records_row_at_a_time(sql, measurements, files):
+    """
+    Adds the new records from a list of lab file dictionaries one at a time, checking if each exists before adding it, and returns the number of records added.
+
+    This makes two round trips to the database per file; add_lab_records should be preferred. It is kept for comparison (see benchmark.py).
+    """
+    count = 0
+    measurements_by_id = {measurement.id : measurement for measurement in measurements}
+
+    # loop through files
+    for file in files:
+        measurement = measurements_by_id.get(file['Measurement'])
+        if measurement is None:
+            # Not a known measurement
+            continue
+        # Create the record_column_decode_dict
+        measurement.create_record_column_decode_dict(file, sql)
+        # Check if record already exists
+        with run_metrics.stage('check_existing_records'):
+            record_exists = sql.check_record_exists(measurement.table_name,
+                                                    measurement.record_column_decode_dict[unique_id_column_name],
+                                                    file[unique_id_column_name])
+        if record_exists:
+            # record exists; do not update
+            run_metrics.count('records_existing')
+        else:
+            # Add new record
+            with run_metrics.stage('insert_records'):
+                sql.add_record(measurement.table_name, file, measurement.record_column_decode_dict)
+            count += 1
+    return count
+
+def create_lab_tables(connect_statement, report_plans=True):
+    """
+    Creates tables hall_lab and icp_lab tables in sql database located at connect_statement (or using an SQL_Connector). This does check to see if table already exists and, if so, does nothing.
 
     If additional labs are done or labs files are modified to contain additional information, the could be modified to adjust the database tables appropriately.
+
+    Indexes are then added where they are missing (see create_lab_indexes), for new and existing tables alike. If any are added and report_plans is True, the query plans of lookups on the indexed columns are printed from before and after.
+    """
+
+    # Connect to database (or use the connection already given); commits and disconnects when done
+    with postgres_handler.use_connection(connect_statement) as sql:
+        # Create sql tables
+        for measurement in measurement_registry.measurement_types():
+            sql.create_table(measurement['sql_table_name'], measurement['sql_column_string'])
+        create_lab_indexes(sql, report_plans)
+
+def indexed_lookups(sql):
+    """
+    Returns list of (table name, column name, unique) for every column create_lab_indexes indexes: each measurement table's sql_unique_id_column_name (unique) and the supporting_indexes of process tables that exist.
+    """
+    lookups = [(measurement['sql_table_name'], measurement['sql_unique_id_column_name'], True) for measurement in measurement_registry.measurement_types()]
+    lookups += [(table_name, column_name, False) for table_name, column_name in supporting_indexes if sql.check_table_exists(table_name)]
+    return lookups
+
+def explain_lookups(sql, lookups):
+    """
+    Returns dictionary {(table name, column name) : list of query plan lines} for a lookup of values in each column (as used when checking for existing records and joining tables; see SQL_Connector.explain).
+    """
+    plans = {}
+    for table_name, column_name, unique in lookups:
+        query = psycopg2_sql.SQL("SELECT * FROM {} WHERE {} = ANY(%s);").format(psycopg2_sql.Identifier(table_name), psycopg2_sql.Identifier(column_name))
+        plans[(table_name, column_name)] = sql.explain(query, ([''],))
+    return plans
+
+def create_lab_indexes(sql, report_plans=True):
+    """
+    Adds a unique constraint to each measurement table's sql_unique_id_column_name (e.g., material_uid) so records can be looked up without scanning the table and the same record cannot be added twice, and an index to each of the supporting_indexes, where the column does not already have an index. Returns the list of (table name, column name) indexed.
+
+    A measurement table that already has duplicate records is given an ordinary index instead and a warning is printed; the duplicates need to be removed before the constraint can be added. Once it has that index it is left as it is until the duplicates are removed.
     """
+    lookups = indexed_lookups(sql)
+    missing = []
+    for table_name, column_name, unique in lookups:
+        indexed_columns = sql.collect_indexed_columns(table_name)
+        if column_name in indexed_columns and (indexed_columns[column_name] or not unique):
+            continue
+        if column_name in indexed_columns and sql.check_column_has_duplicates(table_name, column_name):
+            # already has the index used in place of the unique constraint
+            continue
+        missing.append((table_name, column_name, unique))
+    if not missing:
+        return []
 
-    # Connect to database
-    sql = postgres_handler.SQL_Connector(connect_statement)
+    if report_plans:
+        plans_before = explain_lookups(sql, lookups)
 
-    # Create sql tables
-    for measurement in measurement_types:
-        sql.create_table(measurement['sql_table_name'], measurement['sql_column_string'])
+    added = []
+    for table_name, column_name, unique in missing:
+        if unique and not sql.check_column_has_duplicates(table_name, column_name):
+            sql.add_unique_constraint(table_name, column_name)
+            print(f"Unique constraint added to {table_name}.{column_name}")
+            added.append((table_name, column_name))
+            continue
+        if unique:
+            print(f"Warning: {table_name}.{column_name} has duplicate values; an index was added instead of a unique constraint")
+        sql.create_index(table_name, column_name)
+        # create_index does nothing if an index of the same name already exists
+        if column_name in sql.collect_indexed_columns(table_name):
+            print(f"Index added to {table_name}.{column_name}")
+            added.append((table_name, column_name))
 
-    # Commit and disconnect
-    sql.commit()
-    sql.disconnect()
+    if report_plans and added:
+        plans_after = explain_lookups(sql, lookups)
+        for table_name, column_name, unique in lookups:
+            print(f"Query plan for lookups on {table_name}.{column_name}")
+            print('  before:', '\n          '.join(plans_before[(table_name, column_name)]))
+            print('  after: ', '\n          '.join(plans_after[(table_name, column_name)]))
+    return added
@@ -0,0 +1,162 @@
+import os
+import queue
+import threading
+import time
+
+"""
+The lab watcher reports lab files as they are added to (or changed in) a lab directory, so that they can be added to the database as they arrive instead of listing the whole directory on every run (see collect_labs.py --watch).
+
+Changes are detected with inotify through the watchdog library if it is installed, and otherwise by polling the directory every poll_interval seconds. A file is only reported once nothing has happened to it for debounce seconds, so files still being written are not read early.
+"""
+
+class Lab_Directory_Watcher():
+    def __init__(self, lab_files_directory, debounce=0.2, poll_interval=0.5, max_batch=1000, use_inotify=True):
+        """
+        'debounce' is the number of seconds a file has to go unchanged before it is reported.
+        'poll_interval' is the number of seconds between listings of the directory when polling.
+        'max_batch' is the largest number of files reported at a time.
+        'use_inotify' can be set to False to poll even if watchdog is installed.
+        """
+        self.lab_files_directory = lab_files_directory
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.max_batch = max_batch
+        self.use_inotify = use_inotify
+
+        # file names reported by the observer or polling thread
+        self.events = queue.Queue()
+        # {file name : time of its last event}
+        self.pending = {}
+        self.stop_event = threading.Event()
+        self.observer = None
+        self.poll_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        """
+        Starts watching the directory. Files already in the directory are not reported.
+        """
+        if self.use_inotify:
+            try:
+                from watchdog.observers import Observer
+            except ImportError:
+                Observer = None
+            if Observer is not None:
+                self.observer = Observer()
+                self.observer.schedule(_Event_Handler(self), self.lab_files_directory, recursive=False)
+                self.observer.start()
+                return
+        self.poll_thread = threading.Thread(target=self._poll, daemon=True)
+        self.poll_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.poll_thread is not None:
+            self.poll_thread.join()
+
+    def add_event(self, path):
+        """
+        Records that something happened to path. Only .txt files in the lab directory are kept.
+        """
+        file_name = os.path.basename(path)
+        if file_name[-4:] == '.txt':
+            self.events.put(file_name)
+
+    def retry(self, file_names, delay=0):
+        """
+        Reports file_names again once delay (and debounce) seconds have passed, e.g., files that could not be added to the database. Must be called from the thread calling next_batch.
+        """
+        retry_time = time.monotonic() + delay
+        for file_name in file_names:
+            # a file changed since is still reported after its latest change
+            self.pending[file_name] = max(self.pending.get(file_name, retry_time), retry_time)
+
+    def next_batch(self, timeout=None):
+        """
+        Waits up to timeout seconds (or forever) for files to be added or changed and returns a list of their file names once they have been unchanged for debounce seconds, or an empty list if there were none in time. Files removed before they are reported are left out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            ready = [file_name for file_name, last_event in self.pending.items() if now - last_event >= self.debounce]
+            if ready:
+                ready = sorted(ready)[:self.max_batch]
+                for file_name in ready:
+                    del self.pending[file_name]
+                ready = [file_name for file_name in ready if os.path.exists(os.path.join(self.lab_files_directory, file_name))]
+                if ready:
+                    return ready
+
+            # wait for the next event, the next pending file to be ready or the deadline
+            wait = None
+            if self.pending:
+                wait = max(0, min(self.pending.values()) + self.debounce - now)
+            if deadline is not None:
+                remaining = deadline - now
+                if remaining <= 0:
+                    return []
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                file_name = self.events.get(timeout=wait)
+            except queue.Empty:
+                continue
+            self.pending[file_name] = time.monotonic()
+            # collect any other events that have arrived
+            while True:
+                try:
+                    file_name = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                self.pending[file_name] = time.monotonic()
+
+    def _poll(self):
+        """
+        Lists the directory every poll_interval seconds, reporting files that are new or whose size or modification time has changed.
+        """
+        snapshot = self._snapshot()
+        while not self.stop_event.wait(self.poll_interval):
+            new_snapshot = self._snapshot()
+            for file_name, stat in new_snapshot.items():
+                if snapshot.get(file_name) != stat:
+                    self.add_event(file_name)
+            snapshot = new_snapshot
+
+    def _snapshot(self):
+        """
+        Returns dictionary {file name : (size, mtime_ns)} of the .txt files in the lab directory.
+        """
+        snapshot = {}
+        with os.scandir(self.lab_files_directory) as entries:
+            for entry in entries:
+                if entry.name[-4:] == '.txt':
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+class _Event_Handler():
+    """
+    watchdog event handler passing the paths of files created, changed or moved into the directory to a Lab_Directory_Watcher.
+    """
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == 'moved':
+            self.watcher.add_event(event.dest_path)
+        elif event.event_type in ('created', 'modified', 'closed'):
+            self.watcher.add_event(event.src_path)
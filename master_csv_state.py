@@ -0,0 +1,58 @@
+import json
+import os
+
+"""
+The master csv state is a local json file recording what the last master csv was made from, so that later runs can patch only the rows affected by changes to the database instead of rebuilding the whole file (see csv_creater.update_master_csv).
+
+It records the path and column names of the master csv, a fingerprint of each table used to make it (see SQL_Connector.collect_row_fingerprints) and the keys of each master csv row in file order:
+{'master_path' : master_path,
+ 'columns' : [column names],
+ 'fingerprints' : {table name : {key : md5 hash}},
+ 'row_keys' : [[ball milling uid, hot press uid, sort key]]}
+
+Missing ball milling or hot press uids (rows from only one of the processes) are recorded as null. The sort key is the value the master csv rows are ordered by.
+"""
+
+class Master_CSV_State():
+    def __init__(self, state_path):
+        """
+        'state_path' is the json file to read from and save to; it is created on the first save if it does not exist.
+        """
+        self.state_path = state_path
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as file:
+                state = json.load(file)
+        else:
+            state = {}
+
+        self.master_path = state.get('master_path')
+        self.columns = state.get('columns')
+        self.fingerprints = state.get('fingerprints', {})
+        self.row_keys = state.get('row_keys', [])
+
+    def can_patch(self, columns):
+        """
+        Returns True if the previous master csv still exists and has the given columns, so that it can be patched rather than rebuilt.
+        """
+        return (self.master_path is not None
+                and os.path.exists(self.master_path)
+                and self.columns == columns)
+
+    def save(self, master_path, columns, fingerprints, row_keys):
+        """
+        Records a newly written master csv and writes the state.
+        """
+        self.master_path = master_path
+        self.columns = columns
+        self.fingerprints = fingerprints
+        self.row_keys = row_keys
+
+        # write to a temporary file first so an interrupted save does not corrupt the state
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, "w") as file:
+            json.dump({'master_path' : self.master_path,
+                       'columns' : self.columns,
+                       'fingerprints' : self.fingerprints,
+                       'row_keys' : self.row_keys}, file)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,90 @@
+import json
+import os
+
+"""
+The measurement registry holds the types of measurement that lab result files can contain (e.g., 'ICP', 'Hall'). Each type is described in a json file in the measurements directory, so a new type of measurement is added by adding a file rather than changing the code.
+
+The files are only read the first time a measurement type is needed, and are read once per run. Lab files are matched to their measurement type by looking up the file's 'Measurement' value (see get_measurement_type and lab_to_db_updater.group_files_by_measurement), so matching a file costs the same however many types there are.
+
+Each measurement file should be in the format:
+{"identifier" : the text string found on the lab result file denoting the type of measurment (e.g., "ICP"); it is case sensetive,
+ "sql_table_name" : the name you wish the sql table to be called upon creation,
+ "sql_unique_id_column_name" : "material_uid",
+ "sql_columns" : list of sql strings used to create the sql table, each a column name and data type (e.g., "pb_concentration real"),
+ "field_renames" : optional dictionary {lab file field name : sql column name} for fields whose sql column is not named after the field (see lab_to_db_updater.field_column_name),
+ "order" : optional number; measurement types are listed (and their columns added to the master csv) in this order, then by file name}
+
+NOTE: the sql_unique_id_column_name should be identical to the name used in the sql_columns!
+"""
+
+measurement_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'measurements')
+
+# keys every measurement file must have
+required_keys = ['identifier', 'sql_table_name', 'sql_unique_id_column_name', 'sql_columns']
+
+class Measurement_Registry():
+    def __init__(self, directory=measurement_directory):
+        """
+        'directory' is the directory of measurement json files. Nothing is read until a measurement type is asked for.
+        """
+        self.directory = directory
+        # {identifier : measurement type}, in the order of their "order" values and then file names; None until the files are read
+        self._types = None
+
+    def measurement_types(self):
+        """
+        Returns list of the measurement type dictionaries, each as in its file with the sql_columns also joined into a 'sql_column_string' for create_table.
+        """
+        return list(self._load().values())
+
+    def get_measurement_type(self, identifier):
+        """
+        Returns the measurement type dictionary for identifier (the 'Measurement' value of a lab file), or None if there is no such type.
+        """
+        return self._load().get(identifier)
+
+    def identifiers(self):
+        return list(self._load())
+
+    def _load(self):
+        if self._types is None:
+            loaded = [load_measurement_file(os.path.join(self.directory, file_name))
+                      for file_name in sorted(os.listdir(self.directory)) if file_name[-5:] == '.json']
+            types = {}
+            # sorted is stable, so types with the same order stay in file name order
+            for measurement_type in sorted(loaded, key=lambda measurement_type: measurement_type['order']):
+                if measurement_type['identifier'] in types:
+                    raise ValueError(f"Measurement {measurement_type['identifier']} is defined more than once in {self.directory}")
+                types[measurement_type['identifier']] = measurement_type
+            self._types = types
+        return self._types
+
+def load_measurement_file(path):
+    """
+    Reads and checks a measurement json file, returning its measurement type dictionary.
+    """
+    with open(path) as file:
+        measurement_type = json.load(file)
+    missing = [key for key in required_keys if key not in measurement_type]
+    if missing:
+        raise ValueError(f"Measurement file {path} is missing {', '.join(missing)}")
+    measurement_type.setdefault('field_renames', {})
+    measurement_type.setdefault('order', float('inf'))
+    measurement_type['sql_column_string'] = ',\n'.join(measurement_type['sql_columns'])
+    return measurement_type
+
+# the registry used by the rest of the program (see use_directory)
+registry = Measurement_Registry()
+
+def use_directory(directory):
+    """
+    Makes the measurement types the ones described in directory instead of the measurements directory.
+    """
+    global registry
+    registry = Measurement_Registry(directory)
+
+def measurement_types():
+    return registry.measurement_types()
+
+def get_measurement_type(identifier):
+    return registry.get_measurement_type(identifier)
@@ -1,6 +1,14 @@
+import itertools
+import time
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2 import pool as psycopg2_pool
 from psycopg2 import sql
-from psycopg2.extensions import AsIs
+from psycopg2.extras import execute_values
+from psycopg2.extensions import AsIs, cursor as psycopg2_cursor
+
+import run_metrics
 
 """
 Be wary if editing queries. psycopg2 has guidelines to prevent SQL injection issues.
@@ -8,31 +16,151 @@ Do not use Python string concatenation (+) or string parameters interpolation (%
 https://www.psycopg.org/docs/usage.html
 """
 
+# shared connection pools by connect statement (see get_connection_pool)
+connection_pools = {}
+
+def get_connection_pool(connect_statement, minconn=1, maxconn=10):
+    """
+    returns a thread safe connection pool for connect_statement, creating it the first time it is requested. connections taken from the pool stay open between uses, so repeated runs (e.g., once per lab directory or from a long running service) do not pay to connect each time.
+    """
+    if connect_statement not in connection_pools:
+        connection_pools[connect_statement] = psycopg2_pool.ThreadedConnectionPool(minconn, maxconn, connect_statement)
+    return connection_pools[connect_statement]
+
+def close_connection_pools():
+    """
+    closes every connection in every shared connection pool
+    """
+    for connection_pool in connection_pools.values():
+        connection_pool.closeall()
+    connection_pools.clear()
+
+class Timed_Cursor(psycopg2_cursor):
+    """
+    cursor that records how long each query takes in the current run metrics (see run_metrics.record_query). for server side cursors each fetch is a round trip to the database, so fetches are recorded as well.
+    """
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            run_metrics.record_query(time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            run_metrics.record_query(time.perf_counter() - start)
+
+    def fetchmany(self, size=None):
+        if self.name is None:
+            # the rows are already on the client
+            return super().fetchmany(self.arraysize if size is None else size)
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            run_metrics.record_query(time.perf_counter() - start)
+
+@contextmanager
+def use_connection(connect_statement):
+    """
+    context manager that yields an SQL_Connector for connect_statement, committing when the block finishes and disconnecting afterwards.
+
+    if connect_statement is already an SQL_Connector it is yielded as is and is neither committed nor disconnected; whoever created it is responsible for that. this lets several steps share one connection and transaction.
+    """
+    if isinstance(connect_statement, SQL_Connector):
+        yield connect_statement
+    else:
+        with SQL_Connector(connect_statement) as sql_connector:
+            yield sql_connector
+
 class SQL_Connector():
-    def __init__(self, connect_statement):
+    # used to give each server side cursor a unique name
+    _cursor_counter = itertools.count()
+
+    def __init__(self, connect_statement=None, pool=None, retries=3, retry_delay=1):
+        """
+        connects using connect_statement or, if pool is given, with a connection taken from pool (see get_connection_pool).
+
+        failed connection attempts are retried up to 'retries' times, waiting retry_delay seconds and doubling the wait after each attempt.
+
+        can be used as a context manager: changes are committed if the block finishes without an exception and rolled back if not, then the connection is closed (or returned to the pool).
+        """
+        self.connect_statement = connect_statement
+        self.pool = pool
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        # functions to call after the next commit (e.g., saving an ingestion manifest)
+        self.on_commit = []
+
         # connect to database and create cursor object
-        self.conn = psycopg2.connect(connect_statement)
-        self.cur = self.conn.cursor()
+        self.connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.disconnect()
+        return False
+
+    def connect(self):
+        """
+        establishes the connection and cursor, retrying if the database cannot be reached
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self.pool:
+                    self.conn = self.pool.getconn()
+                else:
+                    self.conn = psycopg2.connect(self.connect_statement)
+                break
+            except psycopg2.OperationalError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+        self.cur = self.conn.cursor(cursor_factory=Timed_Cursor)
 
     def reconnect(self):
         """
-        attempts to close connection and cursor and reestablish them
+        attempts to close connection and cursor and reestablish them. any uncommitted changes are lost.
         """
         try:
             self.cur.close()
-            self.conn.close()
         except:
             pass
-        self.conn = psycopg2.connect(connect_statement)
-        self.cur = self.conn.cursor()
+        try:
+            if self.pool:
+                # do not return a possibly broken connection to the pool for reuse
+                self.pool.putconn(self.conn, close=True)
+            else:
+                self.conn.close()
+        except:
+            pass
+        self.on_commit = []
+        self.connect()
 
     def disconnect(self):
         """
-        disconnects from database
+        disconnects from database (or returns the connection to the pool)
         """
         try:
             self.cur.close()
-            self.conn.close()
+        except:
+            pass
+        try:
+            if self.pool:
+                self.pool.putconn(self.conn)
+            else:
+                self.conn.close()
         except:
             pass
 
@@ -41,6 +169,16 @@ class SQL_Connector():
         commits any changes to the database. nothing changes will be saved to the database unless this is called.
         """
         self.conn.commit()
+        on_commit, self.on_commit = self.on_commit, []
+        for function in on_commit:
+            function()
+
+    def rollback(self):
+        """
+        discards any changes made since the last commit.
+        """
+        self.conn.rollback()
+        self.on_commit = []
 
     def check_table_exists(self, table_name):
         """
@@ -57,10 +195,37 @@ class SQL_Connector():
             .format(table_name=sql.Identifier(table_name),column_name=sql.Identifier(column_name)), (match_value,))
         return self.cur.fetchone()[0]
 
+    def collect_existing_values(self, table_name, column_name, match_values):
+        """
+        returns the set of values from the list "match_values" that are already in column "column_name" of table "table_name".
+
+        this checks any number of values in one query rather than calling check_record_exists once per value.
+        """
+        self.cur.execute(sql.SQL("SELECT {column_name} FROM {table_name} WHERE {column_name} = ANY(%s);")
+            .format(table_name=sql.Identifier(table_name),column_name=sql.Identifier(column_name)), (list(match_values),))
+        return {row[0] for row in self.cur.fetchall()}
+
     def collect_table_column_names(self, table_name):
-        self.cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s;", (table_name,))
+        self.cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s ORDER BY ordinal_position;", (table_name,))
         return [name[0] for name in self.cur.fetchall()]
 
+    def collect_table_column_types(self, table_name):
+        """
+        returns list of (column name, data type) tuples for table table_name in column order (data types as named in information_schema, e.g. 'real', 'character varying', 'boolean')
+        """
+        self.cur.execute("SELECT column_name, data_type FROM information_schema.columns WHERE table_name=%s ORDER BY ordinal_position;", (table_name,))
+        return self.cur.fetchall()
+
+    def collect_table_version(self, table_name):
+        """
+        returns a tuple of strings that changes whenever the rows of table table_name change: the database it is in (name, server address and port), its number of rows and the sum of the ids of the transactions that wrote them (xmin).
+
+        inserts, updates and deletes all change the count or the sum, including those not yet committed in this connection's transaction. the table is scanned but no rows are sent, so this is much quicker than collecting the table.
+        """
+        self.cur.execute(sql.SQL("SELECT current_database(), inet_server_addr()::text, inet_server_port()::text, count(*)::text, COALESCE(sum(xmin::text::bigint), 0)::text FROM {};")
+            .format(sql.Identifier(table_name)))
+        return self.cur.fetchone()
+
     def collect_all_table_records(self, table_name):
         """
         returns list of column names and list of rows (each row as a tuple) for table table_name
@@ -73,6 +238,57 @@ class SQL_Connector():
         rows = self.cur.fetchall()
         return rows, column_names
 
+    def iter_table_records(self, table_name, itersize=2000):
+        """
+        generator version of collect_all_table_records that yields the rows of table table_name in lists of up to itersize rows from a server side cursor (see stream_query). column names can be collected with collect_table_column_names.
+        """
+        return self.stream_query(sql.SQL("SELECT * FROM {};").format(sql.Identifier(table_name)), itersize=itersize)
+
+    def collect_rows_matching_any(self, table_name, column_names, match_values_by_column):
+        """
+        returns list of rows (tuples of the columns in column_names) from table table_name where any of the columns in the dictionary match_values_by_column {column name : list of values} has one of its values.
+        """
+        conditions = []
+        parameters = []
+        for column_name, match_values in match_values_by_column.items():
+            if match_values:
+                conditions.append(sql.SQL("{} = ANY(%s)").format(sql.Identifier(column_name)))
+                parameters.append(list(match_values))
+        if not conditions:
+            return []
+        self.cur.execute(sql.SQL("SELECT {} FROM {} WHERE {};").format(sql.SQL(',').join(map(sql.Identifier, column_names)),
+                                                                       sql.Identifier(table_name),
+                                                                       sql.SQL(' OR ').join(conditions)),
+                         parameters)
+        return self.cur.fetchall()
+
+    def collect_row_fingerprints(self, table_name, key_column, itersize=10000):
+        """
+        returns dictionary {key : md5 hash} of the rows in table table_name grouped by column key_column. the hashes are calculated in the database so only the keys and hashes are sent; a key's hash changes if any of its rows are added, removed or changed. rows without a key are ignored.
+        """
+        query = sql.SQL("""SELECT {key}, md5(string_agg(CAST(fingerprint_row AS text), ',' ORDER BY CAST(fingerprint_row AS text)))
+                           FROM {table} AS fingerprint_row WHERE {key} IS NOT NULL GROUP BY {key};""").format(key=sql.Identifier(key_column),
+                                                                                                            table=sql.Identifier(table_name))
+        fingerprints = {}
+        for rows in self.stream_query(query, itersize=itersize):
+            fingerprints.update(rows)
+        return fingerprints
+
+    def stream_query(self, query, parameters=None, itersize=2000):
+        """
+        generator that runs query on a named (server side) cursor and yields the resulting rows in lists of up to itersize rows, so the whole result is never held in memory at once.
+        """
+        cur = self.conn.cursor(name='stream_cursor_' + str(next(self._cursor_counter)), cursor_factory=Timed_Cursor)
+        try:
+            cur.execute(query, parameters)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
     def create_table(self, table_name, columns_as_sql_str):
         """
         function checks if table_name exists in database, then if it does not creates the table using columns_as_sql_str.
@@ -87,6 +303,48 @@ class SQL_Connector():
             self.cur.execute(sql.SQL("CREATE TABLE {} (%s);").format(sql.Identifier(table_name)), (AsIs(columns_as_sql_str),))
             print(f"Table {table_name} created")
 
+    def collect_indexed_columns(self, table_name):
+        """
+        returns dictionary {column name : True if unique} of the columns that are the first column of an index on table table_name. a column with both a unique and a non unique index is unique.
+        """
+        self.cur.execute("""SELECT a.attname, bool_or(i.indisunique) FROM pg_index i
+                            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                            WHERE i.indrelid = to_regclass(%s) GROUP BY a.attname;""", (table_name,))
+        return dict(self.cur.fetchall())
+
+    def check_column_has_duplicates(self, table_name, column_name):
+        """
+        check if any value appears more than once in column "column_name" of table "table_name"
+        """
+        self.cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {table_name} WHERE {column_name} IS NOT NULL GROUP BY {column_name} HAVING count(*) > 1);")
+            .format(table_name=sql.Identifier(table_name),column_name=sql.Identifier(column_name)))
+        return self.cur.fetchone()[0]
+
+    def add_unique_constraint(self, table_name, column_name):
+        """
+        adds a unique constraint (and the index that enforces it) named table_name_column_name_key on column "column_name" of table "table_name". fails if the column has duplicate values.
+        """
+        self.cur.execute(sql.SQL("ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} UNIQUE ({column_name});")
+            .format(table_name=sql.Identifier(table_name),
+                    constraint_name=sql.Identifier(table_name + '_' + column_name + '_key'),
+                    column_name=sql.Identifier(column_name)))
+
+    def create_index(self, table_name, column_name):
+        """
+        creates an index named table_name_column_name_idx on column "column_name" of table "table_name" if an index with that name does not exist.
+        """
+        self.cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column_name});")
+            .format(table_name=sql.Identifier(table_name),
+                    index_name=sql.Identifier(table_name + '_' + column_name + '_idx'),
+                    column_name=sql.Identifier(column_name)))
+
+    def explain(self, query, parameters=None):
+        """
+        returns the query plan the database would use for query as a list of lines (see the postgres EXPLAIN command). the query is not run.
+        """
+        self.cur.execute(sql.SQL("EXPLAIN {}").format(query), parameters)
+        return [row[0] for row in self.cur.fetchall()]
+
     def add_record(self, table_name, record_as_dict, record_column_decode_dict):
         """
         adds a record to table "table_name" based on dictionary record_as_dict of key values representing the record and a dictionary record_column_decode_dict that should translate the keys in the record_as_dict to the appropriate columns names used in the sql database.
@@ -98,3 +356,26 @@ class SQL_Connector():
 
         self.cur.execute(sql.SQL("INSERT INTO {} (%s) values %s;").format(sql.Identifier(table_name)),
                             (AsIs(','.join(columns)), tuple(values)))
+
+    def add_records(self, table_name, records_as_dicts, record_column_decode_dict, page_size=1000):
+        """
+        adds a list of records to table "table_name" using multi-row inserts of up to page_size rows per statement. records_as_dicts and record_column_decode_dict are handled the same way as in add_record; every record is expected to have the same keys as the first one.
+        """
+        if not records_as_dicts:
+            return
+        keys = list(records_as_dicts[0].keys())
+        columns = [record_column_decode_dict[key] for key in keys]
+        values = [tuple(record[key] for key in keys) for record in records_as_dicts]
+        self.add_rows(table_name, columns, values, page_size)
+
+    def add_rows(self, table_name, column_names, rows, page_size=1000):
+        """
+        adds a list of rows (tuples of values in the order of column_names) to table "table_name" using multi-row inserts of up to page_size rows per statement.
+        """
+        if not rows:
+            return
+        execute_values(self.cur,
+                       sql.SQL("INSERT INTO {} ({}) VALUES %s;").format(sql.Identifier(table_name),
+                                                                      sql.SQL(',').join(map(sql.Identifier, column_names))),
+                       rows,
+                       page_size=page_size)
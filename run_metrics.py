@@ -0,0 +1,173 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+"""
+Run metrics time each stage of a run (e.g., listing and parsing lab files, checking for existing records, inserting, collecting tables, merging) and count what was done in them (files, records, rows and database round trips), so a slow run can be traced to the stage that was slow.
+
+Stages are timed with the stage context manager and counted with count. Both do nothing unless a Run_Metrics has been started, so the rest of the program is instrumented without passing the metrics around:
+
+metrics = run_metrics.Run_Metrics()
+metrics.start()
+... run the pipeline ...
+metrics.stop()
+metrics.write_json('metrics.json')
+
+Stages can be nested (e.g., 'insert_records' runs inside 'add_new_lab_results'), so stage times do not add up to the run time. Database round trips are recorded by postgres_handler.Timed_Cursor.
+"""
+
+# the Run_Metrics being collected, if any (see Run_Metrics.start)
+current = None
+
+# upper bounds (in seconds) of the query latency histogram buckets; slower queries are counted in a final unbounded bucket
+query_latency_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30]
+
+class Run_Metrics():
+    def __init__(self, query_histogram=False):
+        """
+        'query_histogram' also records the latency of each database round trip in query_latency_buckets; otherwise only their number and total time are recorded.
+        """
+        self.query_histogram = query_histogram
+
+        # {stage name : {'seconds' : total seconds, 'calls' : number of times the stage ran}}
+        self.stages = {}
+        # {count name : total}
+        self.counts = {}
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.query_bucket_counts = [0] * (len(query_latency_buckets) + 1)
+
+        self.start_time = None
+        self.seconds = None
+        self._start_counter = None
+
+    def start(self):
+        """
+        Makes these the metrics that stage, count and record_query add to and starts timing the run.
+        """
+        global current
+        current = self
+        self.start_time = time.time()
+        self._start_counter = time.perf_counter()
+
+    def stop(self):
+        """
+        Stops timing the run; stage, count and record_query do nothing until metrics are started again.
+        """
+        global current
+        if current is self:
+            current = None
+        self.seconds = time.perf_counter() - self._start_counter
+
+    def add_stage_time(self, name, seconds):
+        stage_totals = self.stages.setdefault(name, {'seconds' : 0.0, 'calls' : 0})
+        stage_totals['seconds'] += seconds
+        stage_totals['calls'] += 1
+
+    def add_count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_query(self, seconds):
+        self.query_count += 1
+        self.query_seconds += seconds
+        if self.query_histogram:
+            for i, bucket in enumerate(query_latency_buckets):
+                if seconds <= bucket:
+                    self.query_bucket_counts[i] += 1
+                    break
+            else:
+                self.query_bucket_counts[-1] += 1
+
+    def report(self):
+        """
+        Returns the metrics as a dictionary that can be written as json.
+        """
+        report = {'start_time' : self.start_time,
+                  'seconds' : self.seconds,
+                  'stages' : self.stages,
+                  'counts' : self.counts,
+                  'queries' : {'count' : self.query_count, 'seconds' : self.query_seconds}}
+        if self.query_histogram:
+            # cumulative counts as in a Prometheus histogram
+            cumulative = 0
+            buckets = {}
+            for bucket, bucket_count in zip([str(bucket) for bucket in query_latency_buckets] + ['+Inf'], self.query_bucket_counts):
+                cumulative += bucket_count
+                buckets[bucket] = cumulative
+            report['queries']['buckets'] = buckets
+        return report
+
+    def write_json(self, output_path):
+        with open(output_path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def write_prometheus(self, output_path, prefix='collect_labs'):
+        """
+        Writes the metrics in the Prometheus text format, for use with the node exporter's textfile collector. The file is written to a temporary file first so the collector never reads a partial file.
+        """
+        report = self.report()
+        lines = [f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                 f'{prefix}_last_run_timestamp_seconds {report["start_time"]}',
+                 f'# TYPE {prefix}_run_seconds gauge',
+                 f'{prefix}_run_seconds {report["seconds"]}',
+                 f'# TYPE {prefix}_stage_seconds gauge']
+        lines += [f'{prefix}_stage_seconds{{stage="{name}"}} {stage["seconds"]}' for name, stage in report['stages'].items()]
+        lines.append(f'# TYPE {prefix}_stage_calls gauge')
+        lines += [f'{prefix}_stage_calls{{stage="{name}"}} {stage["calls"]}' for name, stage in report['stages'].items()]
+        for name, total in report['counts'].items():
+            lines += [f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {total}']
+        if self.query_histogram:
+            lines.append(f'# TYPE {prefix}_query_seconds histogram')
+            lines += [f'{prefix}_query_seconds_bucket{{le="{bucket}"}} {bucket_count}' for bucket, bucket_count in report['queries']['buckets'].items()]
+        else:
+            lines.append(f'# TYPE {prefix}_query_seconds summary')
+        lines += [f'{prefix}_query_seconds_sum {report["queries"]["seconds"]}',
+                  f'{prefix}_query_seconds_count {report["queries"]["count"]}']
+
+        temp_path = output_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, output_path)
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that adds the time spent in the block to stage 'name' of the current metrics.
+    """
+    metrics = current
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_stage_time(name, time.perf_counter() - start)
+
+def count(name, n=1):
+    """
+    Adds n to count 'name' of the current metrics (e.g., count('records_added', 10)).
+    """
+    if current is not None:
+        current.add_count(name, n)
+
+def record_query(seconds):
+    """
+    Records a database round trip that took 'seconds' in the current metrics.
+    """
+    if current is not None:
+        current.add_query(seconds)
+
+def timed_iter(iterable, name):
+    """
+    Generator that yields the items of iterable, adding the time spent producing each one to stage 'name' (e.g., the time spent parsing files yielded by a generator, but not the time spent using them).
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
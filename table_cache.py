@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+"""
+The table cache is a local directory of snapshots of the tables used to make the master csv, so that repeated builds do not collect tables that have not changed since the last one (see csv_creater.collect_table_dataframe).
+
+Each snapshot is a Feather (Arrow IPC) file named by a hash of its key: the table name, its columns and dtypes and its version in the database (see SQL_Connector.collect_table_version). A changed table has a new version and so a new file; the old file is never read again and is removed once the cache is full. Snapshots are read with memory mapping and written uncompressed so they are not copied or decompressed on the way in.
+
+When the files take up more than max_bytes, the least recently used are removed (see evict). The cache needs the pyarrow library.
+"""
+
+# file extension of the snapshots
+snapshot_extension = '.feather'
+
+class Table_Cache():
+    def __init__(self, cache_directory, max_bytes=1024 * 1024 * 1024):
+        """
+        'cache_directory' is the directory the snapshots are kept in; it is created if it does not exist.
+        'max_bytes' is the total size the snapshots are kept under (default 1 GB).
+
+        Raises ImportError if pyarrow is not installed.
+        """
+        import pyarrow.feather
+
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+    def snapshot_path(self, key):
+        """
+        Returns the path of the snapshot for key, any json serializable value (e.g., [table name, columns, version]).
+        """
+        key_hash = hashlib.sha256(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_directory, key_hash + snapshot_extension)
+
+    def load(self, key):
+        """
+        Returns the DataFrame stored for key, or None if there is none. A snapshot that cannot be read is removed.
+        """
+        import pyarrow
+        import pyarrow.feather
+
+        path = self.snapshot_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            df = pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+        except (pyarrow.ArrowException, OSError):
+            remove_file(path)
+            return None
+        # mark the snapshot as recently used (see evict)
+        os.utime(path)
+        return df
+
+    def store(self, key, df):
+        """
+        Stores DataFrame df for key and removes the least recently used snapshots if the cache is now too big. Returns False if df could not be stored (e.g., a column of values pyarrow cannot convert); the cache is only an optimization, so this is not an error.
+        """
+        import pyarrow
+        import pyarrow.feather
+
+        path = self.snapshot_path(key)
+        # write to a temporary file first so an interrupted write is never read as a snapshot
+        temp_path = path + '.tmp'
+        try:
+            pyarrow.feather.write_feather(df, temp_path, compression='uncompressed')
+            os.replace(temp_path, path)
+        except (pyarrow.ArrowException, ValueError, TypeError, OSError):
+            remove_file(temp_path)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Removes the least recently used snapshots (by modification time, which load updates) until the snapshots take up no more than max_bytes.
+        """
+        snapshots = []
+        with os.scandir(self.cache_directory) as entries:
+            for entry in entries:
+                if entry.name[-len(snapshot_extension):] == snapshot_extension:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshots.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_bytes = sum(size for mtime, size, path in snapshots)
+        for mtime, size, path in sorted(snapshots):
+            if total_bytes <= self.max_bytes:
+                break
+            remove_file(path)
+            total_bytes -= size
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,96 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('psycopg2')
+
+import csv_creater
+
+"""
+Checks that the pivoted versions of the pandas merges in csv_creater give the same master csv as the merges they replaced: split_and_merge_materials against split_and_merge_materials_loop, and add_lab_results against merging the lab table once per process (add_lab_results_merge below).
+
+These tests need no database; the lab tables are read from Fake_SQL instead.
+"""
+
+ball_milling_key = csv_creater.hot_press_uid_column + csv_creater.ball_milling_suffix
+
+# Ball milling processes (as merged with hot press) of which BM-3 has no materials and BM-4 has no hot press
+merge_rows = [('BM-1', 'BM-OUT-1', 'HP-OUT-1', 15.0),
+              ('BM-2', 'BM-OUT-2', 'HP-OUT-2', 30.0),
+              ('BM-3', 'BM-OUT-3', 'HP-OUT-3', None),
+              ('BM-4', 'BM-OUT-4', None, 45.0)]
+merge_columns = [ball_milling_key, 'ball_milling_output_material_uid', 'hot_press_output_material_uid', 'milling_time']
+
+# Materials in a different order for each process, PR-6 procured for a process not in merge_rows and PR-7 with no material name
+materials_rows = [('PR-1', 'Bi', 0.5, 'BM-1'),
+                  ('PR-2', 'Te', 0.5, 'BM-1'),
+                  ('PR-3', 'Te', 0.4, 'BM-2'),
+                  ('PR-4', 'Sb', None, 'BM-2'),
+                  ('PR-5', 'Bi', 0.2, 'BM-2'),
+                  ('PR-6', 'Se', 1.0, 'BM-9'),
+                  ('PR-7', None, 0.1, 'BM-4')]
+materials_columns = ['uid', csv_creater.material_type_column, 'mass_fraction', csv_creater.materials_ball_milling_column]
+
+measurement = {'sql_table_name' : 'hall', 'sql_unique_id_column_name' : 'material_uid'}
+processes = [('bm', 'ball_milling_output_material_uid'),
+             ('hp', 'hot_press_output_material_uid')]
+
+# Hall results, with a NULL value and a NULL boolean, for some of the output materials and one material not in merge_rows
+hall_column_types = [('material_uid', 'character varying'),
+                     ('measurement', 'character varying'),
+                     ('probe_resistance_ohm', 'real'),
+                     ('magnet_reversal', 'boolean')]
+hall_rows = [('HP-OUT-1', 'Hall', 1.5, True),
+             ('BM-OUT-2', 'Hall', None, False),
+             ('HP-OUT-2', 'Hall', 2.5, None),
+             ('BM-OUT-4', 'Hall', 3.5, True),
+             ('XX-OUT-9', 'Hall', 4.5, False)]
+
+class Fake_SQL():
+    """
+    Stands in for postgres_handler.SQL_Connector, giving the hall table to csv_creater.collect_table_dataframe.
+    """
+    def collect_table_column_types(self, table_name):
+        return hall_column_types
+
+    def iter_table_records(self, table_name, itersize=2000):
+        for start in range(0, len(hall_rows), itersize):
+            yield hall_rows[start:start + itersize]
+
+def merge_df():
+    return pd.DataFrame(merge_rows, columns=merge_columns)
+
+def materials_df():
+    # as collected by csv_creater.collect_table_dataframe
+    return pd.DataFrame(materials_rows, columns=materials_columns).astype({'mass_fraction' : 'float32', csv_creater.material_type_column : 'category'})
+
+def add_lab_results_merge(sql, merge_df, measurement, processes):
+    """
+    The version of csv_creater.add_lab_results that merged merge_df with the lab table once per process.
+    """
+    lab_table = csv_creater.collect_table_dataframe(sql, measurement['sql_table_name'])
+    for process in processes:
+        prefix = process[0]+'_'+measurement['sql_table_name']+'_'
+        new_unique_column = prefix + measurement['sql_unique_id_column_name']
+        merge_df = merge_df.merge(lab_table.add_prefix(prefix),
+                                  how='left',
+                                  left_on=process[1],
+                                  right_on=new_unique_column)
+        merge_df[prefix + 'results'] = merge_df[new_unique_column].notnull()
+        merge_df.drop(new_unique_column, axis=1, inplace=True)
+    return merge_df
+
+def test_split_and_merge_materials_matches_loop():
+    arguments = {'merge_df_column_to_merge_on' : ball_milling_key,
+                 'materials_df_column_to_merge_on' : csv_creater.materials_ball_milling_column,
+                 'material_type_column_name' : csv_creater.material_type_column}
+    # the loop fails on materials with no name, which split_and_merge_materials leaves out
+    looped = csv_creater.split_and_merge_materials_loop(merge_df(), materials_df().dropna(subset=[csv_creater.material_type_column]), **arguments)
+    pivoted = csv_creater.split_and_merge_materials(merge_df(), materials_df(), **arguments)
+    assert list(pivoted.columns) == list(looped.columns)
+    assert pivoted.to_csv() == looped.to_csv()
+
+def test_add_lab_results_matches_merge():
+    merged = add_lab_results_merge(Fake_SQL(), merge_df(), measurement, processes)
+    looked_up = csv_creater.add_lab_results(Fake_SQL(), merge_df(), measurement, processes)
+    assert list(looked_up.columns) == list(merged.columns)
+    assert looked_up.to_csv() == merged.to_csv()
@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+import postgres_handler
+import lab_to_db_updater
+import csv_creater
+
+"""
+Checks that the ways of making the master csv write the same file: merging the tables with pandas (see csv_creater.build_master_dataframe), a single query (see csv_creater.write_master_csv_sql) and patching the previous master csv (see csv_creater.update_master_csv).
+
+These tests need an empty throwaway PostgreSQL database named by the MATERIALS_PIPELINE_TEST_DB environment variable (e.g., MATERIALS_PIPELINE_TEST_DB='dbname=pipeline_test'); they are skipped without one. Everything is done inside a transaction that is rolled back.
+"""
+
+test_database = os.environ.get('MATERIALS_PIPELINE_TEST_DB')
+
+# Process tables as in x-materials-database/processdb.sql, with fewer columns
+process_tables = {'hot_press' : """
+                  uid character varying(30) NOT NULL PRIMARY KEY,
+                  process_name character varying(40),
+                  hot_press_temperature real,
+                  output_material_name character varying(40),
+                  output_material_uid character varying(30) NOT NULL
+                  """,
+                  'ball_milling' : """
+                  uid character varying(30) NOT NULL PRIMARY KEY,
+                  process_name character varying(40),
+                  milling_time real,
+                  output_material_name character varying(40),
+                  output_material_uid character varying(30) NOT NULL,
+                  hot_press_uid character varying(30) REFERENCES hot_press(uid)
+                  """,
+                  'material_procurement' : """
+                  uid character varying(30) NOT NULL PRIMARY KEY,
+                  material_name character varying(20),
+                  mass_fraction real,
+                  ball_milling_uid character varying(30) REFERENCES ball_milling(uid)
+                  """}
+
+hot_press_columns = ['uid', 'process_name', 'hot_press_temperature', 'output_material_name', 'output_material_uid']
+ball_milling_columns = ['uid', 'process_name', 'milling_time', 'output_material_name', 'output_material_uid', 'hot_press_uid']
+materials_columns = ['uid', 'material_name', 'mass_fraction', 'ball_milling_uid']
+icp_columns = ['material_uid', 'measurement', 'pb_concentration']
+hall_columns = ['material_uid', 'measurement', 'probe_resistance_ohm', 'magnet_reversal']
+
+@pytest.fixture
+def sql():
+    if not test_database:
+        pytest.skip('MATERIALS_PIPELINE_TEST_DB is not set')
+    sql = postgres_handler.SQL_Connector(test_database)
+    try:
+        for table_name, column_string in process_tables.items():
+            sql.create_table(table_name, column_string)
+        lab_to_db_updater.create_lab_tables(sql, report_plans=False)
+
+        sql.add_rows('hot_press', hot_press_columns, [('HP-1', 'press', 500, 'pressed', 'HP-1-OUT'),
+                                                       ('HP-2', 'press', 550, 'pressed', 'HP-2-OUT'),
+                                                       ('HP-3', 'press', 600, 'pressed', 'HP-3-OUT')])
+        # BM-1 and BM-2 share a hot press and BM-3 and BM-4 have none, so their rows have the same sort key
+        sql.add_rows('ball_milling', ball_milling_columns, [('BM-2', 'mill', 10, 'milled', 'BM-2-OUT', 'HP-1'),
+                                                             ('BM-1', 'mill', 12, 'milled', 'BM-1-OUT', 'HP-1'),
+                                                             ('BM-4', 'mill', 14, 'milled', 'BM-4-OUT', None),
+                                                             ('BM-3', 'mill', 16, 'milled', 'BM-3-OUT', None),
+                                                             ('BM-5', 'mill', 18, 'milled', 'BM-5-OUT', 'HP-2')])
+        sql.add_rows('material_procurement', materials_columns, [('M-1', 'Pb', 0.5, 'BM-1'),
+                                                                  ('M-2', 'Sn', 0.5, 'BM-1'),
+                                                                  ('M-3', 'Pb', 0.25, 'BM-2'),
+                                                                  ('M-4', 'Sn', 0.75, 'BM-5')])
+        # lab results with missing (NULL) values and booleans
+        sql.add_rows('icp_lab', icp_columns, [('BM-1-OUT', 'ICP', 0.4),
+                                              ('HP-1-OUT', 'ICP', 0.3),
+                                              ('HP-2-OUT', 'ICP', None)])
+        sql.add_rows('hall_lab', hall_columns, [('BM-1-OUT', 'Hall', 12.5, True),
+                                                ('BM-3-OUT', 'Hall', None, False),
+                                                ('HP-3-OUT', 'Hall', 3.25, None)])
+        yield sql
+    finally:
+        sql.rollback()
+        sql.disconnect()
+
+def read_file(path):
+    with open(path, 'r', newline='', encoding='utf-8') as file:
+        return file.read()
+
+def write_master_csv_pandas(sql, output_path):
+    csv_creater.write_master_csv(csv_creater.build_master_dataframe(sql), output_path)
+
+def change_fixture(sql):
+    # Change processes with tied sort keys, materials and lab results
+    sql.cur.execute("UPDATE ball_milling SET milling_time = 20 WHERE uid = 'BM-2';")
+    sql.cur.execute("DELETE FROM ball_milling WHERE uid = 'BM-4';")
+    sql.add_rows('ball_milling', ball_milling_columns, [('BM-0', 'mill', 8, 'milled', 'BM-0-OUT', 'HP-1'),
+                                                         ('BM-6', 'mill', 6, 'milled', 'BM-6-OUT', None)])
+    sql.add_rows('material_procurement', materials_columns, [('M-5', 'Pb', 1.0, 'BM-0')])
+    sql.add_rows('icp_lab', icp_columns, [('BM-5-OUT', 'ICP', 0.2)])
+    sql.add_rows('hall_lab', hall_columns, [('BM-0-OUT', 'Hall', None, True)])
+
+@pytest.mark.parametrize('changed', [False, True])
+def test_sql_engine_matches_pandas_engine(sql, tmp_path, changed):
+    if changed:
+        change_fixture(sql)
+    pandas_path = str(tmp_path / 'pandas.csv')
+    sql_path = str(tmp_path / 'sql.csv')
+    write_master_csv_pandas(sql, pandas_path)
+    csv_creater.write_master_csv_sql(sql, sql_path)
+    assert read_file(sql_path) == read_file(pandas_path)
+
+def test_patched_master_csv_matches_rebuilt(sql, tmp_path):
+    state_path = str(tmp_path / 'state.json')
+    patched_path = str(tmp_path / 'patched.csv')
+    rebuilt_path = str(tmp_path / 'rebuilt.csv')
+
+    # The first update writes the whole master csv
+    csv_creater.update_master_csv(sql, patched_path, state_path)
+    csv_creater.write_master_csv_sql(sql, rebuilt_path)
+    assert read_file(patched_path) == read_file(rebuilt_path)
+
+    change_fixture(sql)
+
+    # The second update patches it
+    csv_creater.update_master_csv(sql, patched_path, state_path)
+    csv_creater.write_master_csv_sql(sql, rebuilt_path)
+    assert read_file(patched_path) == read_file(rebuilt_path)
+
+@pytest.mark.parametrize('write_master', [csv_creater.write_master_csv_sql, write_master_csv_pandas])
+def test_master_csv_orders_tied_rows_by_ball_milling_uid(sql, tmp_path, write_master):
+    rebuilt_path = str(tmp_path / 'rebuilt.csv')
+    write_master(sql, rebuilt_path)
+    with open(rebuilt_path, 'r', newline='', encoding='utf-8') as file:
+        ball_milling_uids = [line.split(',')[1] for line in file.read().splitlines()[1:]]
+    assert ball_milling_uids == ['BM-1', 'BM-2', 'BM-5', '', 'BM-3', 'BM-4']